@@ -1,9 +1,10 @@
 import numpy as np
 import math
 import json
-from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 from mission_config import ANALYZED_MISSIONS
 from numpy_encoder import NumpyEncoder
+from result_io import find_result_file, read_result, result_path
 
 # latitudes over which it is sea, by mission
 SEA_LONGITUDES = {
@@ -12,20 +13,28 @@ SEA_LONGITUDES = {
     77: [-77.39, -7.7]
 }
 
-def analyze_result(result, mission, ellapsed=None, debug=True):
-    def average(key, values=result):
-        filtered = [d[key] for d in values if d[key] is not None]
-        if len(filtered) == 0:
-            return float('NaN')
+def region_means(columns, regions):
+    """
+    Means of each column (name -> (values, valid rows)) over each region (name -> rows), counting only the valid rows,
+    computed in a single pass over all of them. Regions without valid rows have a NaN mean
+    """
+    values = np.stack([values for values, _ in columns.values()], axis=1)
+    valid = np.stack([valid for _, valid in columns.values()], axis=1)
+    included = np.stack(list(regions.values())).astype(float)
+
+    # region x column sums and counts, as products of the region x row and row x column matrices
+    sums = included @ np.where(valid, values, 0.0)
+    counts = included @ valid
+    # a NaN counted as valid makes the mean NaN, but only in the regions it is in
+    has_nan = included @ (valid & np.isnan(values))
 
-        return float(np.mean(filtered))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(has_nan > 0, np.nan, np.nan_to_num(sums, nan=0.0) / counts)
 
-    def rms(values):
-        if len(values) == 0:
-            return float('NaN')
+    return {region: dict(zip(columns.keys(), row.tolist())) for region, row in zip(regions.keys(), means)}
 
-        return float(math.sqrt(np.mean([error**2 for error in values])))
 
+def get_regions(result, mission):
     sea_start_longitude = -65.0
     sea_end_longitude = -8.0
     if mission in SEA_LONGITUDES:
@@ -36,74 +45,99 @@ def analyze_result(result, mission, ellapsed=None, debug=True):
         else:
             sea_start_longitude = longitudes
 
-    over_land = [d for d in result if d['longitude'] < sea_start_longitude or d['longitude'] > sea_end_longitude]
-    over_sea = [d for d in result if sea_start_longitude <= d['longitude'] <= sea_end_longitude]
+    return {
+        'everywhere': np.ones(len(result), dtype=bool),
+        'over_land': (result['longitude'] < sea_start_longitude) | (result['longitude'] > sea_end_longitude),
+        'over_sea': (sea_start_longitude <= result['longitude']) & (result['longitude'] <= sea_end_longitude)
+    }
+
+
+def analyze_result(result, mission, ellapsed=None, debug=True):
+    has_speed_error = ~np.isnan(result['speed_error'])
+    has_bearing = ~np.isnan(result['data_bearing'])
+    speed_error = result['speed_error']
+    bearing_error = result['data_bearing'] - result['model_bearing']
+
+    columns = {}
+    for key in ['data_speed', 'model_speed', 'speed_error', 'data_bearing', 'model_bearing']:
+        columns[key] = (result[key], ~np.isnan(result[key]))
+    columns['squared_speed_error'] = (speed_error**2, has_speed_error)
+    columns['squared_bearing_error'] = (bearing_error**2, has_bearing)
+    # over land and sea, bearing errors are counted where there are speed errors
+    columns['squared_bearing_error_with_speed'] = (bearing_error**2, has_speed_error)
+    columns['absolute_bearing_error'] = (np.abs(bearing_error), has_bearing)
+
+    means = region_means(columns, get_regions(result, mission))
+    everywhere, over_land, over_sea = means['everywhere'], means['over_land'], means['over_sea']
 
     analysis = {
         'ellapsed': ellapsed,
 
         'speed': {
-            'speed_error_percent': 100.0*abs(average('data_speed') - average('model_speed')) / average('model_speed'),
-            'net_speed_error': abs(average('data_speed') - average('model_speed')),
-            'average_data_speed': average('data_speed'),
-            'average_model_speed': average('model_speed'),
-            'average_speed_error': average('speed_error'),
-            'rms_speed_error': rms([d['speed_error'] for d in result if d['speed_error'] is not None]),
+            'speed_error_percent': 100.0*abs(everywhere['data_speed'] - everywhere['model_speed']) / everywhere['model_speed'],
+            'net_speed_error': abs(everywhere['data_speed'] - everywhere['model_speed']),
+            'average_data_speed': everywhere['data_speed'],
+            'average_model_speed': everywhere['model_speed'],
+            'average_speed_error': everywhere['speed_error'],
+            'rms_speed_error': math.sqrt(everywhere['squared_speed_error']),
             'over_land': {
-                'net_speed_error_over_land': abs(average('data_speed', values=over_land) - average('model_speed', values=over_land)),
-                'average_data_speed_over_land': average('data_speed', values=over_land),
-                'average_model_speed_over_land': average('model_speed', values=over_land),
-                'rms_speed_error_over_land': rms([d['speed_error'] for d in over_land if d['speed_error'] is not None]),
+                'net_speed_error_over_land': abs(over_land['data_speed'] - over_land['model_speed']),
+                'average_data_speed_over_land': over_land['data_speed'],
+                'average_model_speed_over_land': over_land['model_speed'],
+                'rms_speed_error_over_land': math.sqrt(over_land['squared_speed_error']),
             },
             'over_sea': {
-                'net_speed_error_over_sea': abs(average('data_speed', values=over_sea) - average('model_speed', values=over_sea)),
-                'average_data_speed_over_sea': average('data_speed', values=over_sea),
-                'average_model_speed_over_sea': average('model_speed', values=over_sea),
-                'rms_speed_error_over_sea': rms([d['speed_error'] for d in over_sea if d['speed_error'] is not None]),
+                'net_speed_error_over_sea': abs(over_sea['data_speed'] - over_sea['model_speed']),
+                'average_data_speed_over_sea': over_sea['data_speed'],
+                'average_model_speed_over_sea': over_sea['model_speed'],
+                'rms_speed_error_over_sea': math.sqrt(over_sea['squared_speed_error']),
             }
         },
 
         'bearing': {
-            'net_bearing_error': abs(average('data_bearing') - average('model_bearing')),
-            'average_data_bearing': average('data_bearing'),
-            'average_model_bearing': average('model_bearing'),
-            'average_bearing_error': float(np.mean([abs(d['data_bearing'] - d['model_bearing']) for d in result if d['data_bearing'] is not None])),
+            'net_bearing_error': abs(everywhere['data_bearing'] - everywhere['model_bearing']),
+            'average_data_bearing': everywhere['data_bearing'],
+            'average_model_bearing': everywhere['model_bearing'],
+            'average_bearing_error': everywhere['absolute_bearing_error'],
 
-            'rms_bearing_error': rms([d['data_bearing'] - d['model_bearing'] for d in result if d['data_bearing'] is not None]),
+            'rms_bearing_error': math.sqrt(everywhere['squared_bearing_error']),
             'over_land': {
-                'net_bearing_error_over_land': abs(average('data_bearing', values=over_land) - average('model_bearing', values=over_land)),
-                'average_data_bearing_over_land': average('data_bearing', values=over_land),
-                'average_model_bearing_over_land': average('model_bearing', values=over_land),
-                'rms_bearing_error_over_land': rms([d['data_bearing'] - d['model_bearing'] for d in over_land if d['speed_error'] is not None]),
+                'net_bearing_error_over_land': abs(over_land['data_bearing'] - over_land['model_bearing']),
+                'average_data_bearing_over_land': over_land['data_bearing'],
+                'average_model_bearing_over_land': over_land['model_bearing'],
+                'rms_bearing_error_over_land': math.sqrt(over_land['squared_bearing_error_with_speed']),
             },
             'over_sea': {
-                'net_bearing_error_over_sea': abs(average('data_bearing', values=over_sea) - average('model_bearing', values=over_sea)),
-                'average_data_bearing_over_sea': average('data_bearing', values=over_sea),
-                'average_model_bearing_over_sea': average('model_bearing', values=over_sea),
-                'rms_bearing_error_over_sea': rms([d['data_bearing'] - d['model_bearing'] for d in over_sea if d['speed_error'] is not None]),
+                'net_bearing_error_over_sea': abs(over_sea['data_bearing'] - over_sea['model_bearing']),
+                'average_data_bearing_over_sea': over_sea['data_bearing'],
+                'average_model_bearing_over_sea': over_sea['model_bearing'],
+                'rms_bearing_error_over_sea': math.sqrt(over_sea['squared_bearing_error_with_speed']),
             }
         }
     }
 
     if debug:
-        print('\t[Analysis]')
-        for line in json.dumps(analysis, cls=NumpyEncoder, indent=4).split('\n'):
-            print('\t[Analysis]\t %s' % line)
-        print('\t[Analysis]')
+        print_analysis(analysis)
 
     return analysis
 
-def analyze_result_from_disk(mission, habmc):
+
+def print_analysis(analysis, title=''):
+    print('\t[Analysis] %s' % title if title else '\t[Analysis]')
+    for line in json.dumps(analysis, cls=NumpyEncoder, indent=4).split('\n'):
+        print('\t[Analysis]\t %s' % line)
+    print('\t[Analysis]')
+
+def analyze_result_from_disk(mission, habmc, debug=True):
     output_dir = 'data/analyzed'
-    result_file = output_dir + '/ssi-' + str(mission) + '-%s.json' % ('habmc' if habmc else 'dataframe')
-    if not Path(result_file).is_file():
-        print('\t[Analysis] Cannot analyze %s as it does not exist' % result_file.split('/')[-1])
+    result_file = find_result_file(mission, habmc)
+    if result_file is None:
+        print('\t[Analysis] Cannot analyze %s as it does not exist' % result_path(mission, habmc).split('/')[-1])
         return
 
     print('\t[Analysis] Analyzing %s' % result_file.split('/')[-1])
 
-    with open(result_file, 'r') as f:
-        analysis = analyze_result(json.loads(f.read()), mission)
+    analysis = analyze_result(read_result(result_file), mission, debug=debug)
 
     with open(output_dir + '/ssi-' + str(mission) + '-%s-analysis.json' % ('habmc' if habmc else 'dataframe'), 'w') as f:
         f.write(json.dumps(analysis, cls=NumpyEncoder, indent=4))
@@ -111,25 +145,46 @@ def analyze_result_from_disk(mission, habmc):
     return analysis
 
 
-def analyze_all():
-    analyses = []
-    for mission, has_dataframe in ANALYZED_MISSIONS.items():
-        analysis = analyze_result_from_disk(mission, habmc=True)
-        if has_dataframe:
-            analysis = analyze_result_from_disk(mission, habmc=False)
+def aggregate(analyses):
+    """
+    Averages every metric over the analyses, ignoring the ones it is missing (None or NaN) from
+    """
+    overall = {}
+    for key, value in analyses[0].items():
+        if isinstance(value, dict):
+            overall[key] = aggregate([analysis[key] for analysis in analyses])
+            continue
 
-        analyses.append(analysis)
+        values = np.array([analysis[key] for analysis in analyses], dtype=float)
+        values = values[~np.isnan(values)]
+        overall[key] = float(np.mean(values)) if len(values) > 0 else float('NaN')
 
-    overall = {
-        'speed': {
-            'speed_error_percent': float(np.mean([d['speed']['speed_error_percent'] for d in analyses]))
-        }
-    }
+    return overall
+
+
+def analyze_all(jobs=None):
+    tasks = [(mission, True) for mission in ANALYZED_MISSIONS] + [(mission, False) for mission, has_dataframe in ANALYZED_MISSIONS.items() if has_dataframe]
+
+    # the analyses are printed here rather than by the workers, so that they do not interleave
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        analyses = dict(zip(tasks, executor.map(analyze_result_from_disk, *zip(*tasks), [False]*len(tasks))))
+
+    for task in tasks:
+        if analyses[task] is not None:
+            print_analysis(analyses[task], title='ssi-%s-%s' % (task[0], 'habmc' if task[1] else 'dataframe'))
+
+    # missions with a dataframe are summarized by their dataframe analysis
+    summarized = [analyses[(mission, not has_dataframe)] for mission, has_dataframe in ANALYZED_MISSIONS.items()]
+    summarized = [analysis for analysis in summarized if analysis is not None]
+    if len(summarized) == 0:
+        print('\t[Analysis] Nothing to summarize')
+        return None
+
+    overall = aggregate(summarized)
+    print_analysis(overall, title='Summary over %d missions' % len(summarized))
+
+    return overall
 
-    print('\t[Analysis] Summary')
-    for line in json.dumps(overall, cls=NumpyEncoder, indent=4).split('\n'):
-        print('\t[Analysis]\t %s' % line)
-    print('\t[Analysis]')
 
 if __name__ == "__main__":
-    analyze_all()
\ No newline at end of file
+    analyze_all()
@@ -0,0 +1,108 @@
+import os
+import numpy as np
+from datetime import datetime, timezone
+import dataset_manager
+import grib_utils
+from download_grib import DATA_DIR, output_path_for
+from columns import empty_columns, TRANSMISSION_DTYPE
+
+"""
+Synthetic GFS data for the benchmarks, so that they do not need to download anything. GRIB files cannot be written
+without a template, so the datasets are written as the decoded .uv.npy files grib_utils reads instead (next to empty
+.grb2 files, so they count as downloaded), along with an index of them. Everything is written to the current directory
+"""
+
+HOURS_TO_MS = 60*60*1000
+
+START = datetime(2018, 11, 1, tzinfo=timezone.utc).timestamp() * 1000
+CYCLES = 12  # 6 hourly forecast cycles, each with datasets at offsets 0, 3, and 6 hours
+GRID_STEP = 2.0  # degrees
+LEVELS = [100, 150, 200, 250, 300, 400, 500, 700, 850, 925, 1000]
+
+
+def create_fixture():
+    set_grid()
+    os.makedirs(DATA_DIR, exist_ok=True)
+
+    dataset_manager.index = {}
+    for cycle in range(CYCLES):
+        timestamp = START + cycle*6*HOURS_TO_MS
+        day = datetime.fromtimestamp(timestamp / 1000.0, tz=timezone.utc)
+
+        for offset in [0, 3, 6]:
+            url = '%s%s/%s/gfs_4_%s_%02d00_%03d.grb2' % (
+                dataset_manager.GFS_BASE_URL, day.strftime('%Y%m'), day.strftime('%Y%m%d'), day.strftime('%Y%m%d'), day.hour, offset
+            )
+            dataset_manager.index[url] = {
+                'url': url,
+                'year': day.year,
+                'month': day.month,
+                'day': day.day,
+                'hour': day.hour,
+                'offset': offset,
+                'timestamp': timestamp
+            }
+
+            path = output_path_for(url)
+            open(path, 'w').close()
+            grib_utils.write_sidecar(path, synthetic_cube(timestamp + offset*HOURS_TO_MS))
+
+    # mark the months as indexed so that they are not crawled
+    dataset_manager.indexed_months.update(dataset_manager.months_between(START - dataset_manager.LOOKUP_MARGIN, end_time() + dataset_manager.LOOKUP_MARGIN))
+    dataset_manager.invalidate_timeline()
+
+
+# sets the grid axes directly, as there is no sample grib file to read them from
+def set_grid():
+    grib_utils.latitudes = np.arange(-90, 90 + GRID_STEP/2, GRID_STEP)
+    grib_utils.longitudes = np.arange(0, 360, GRID_STEP)
+    grib_utils.levels = list(LEVELS)
+    grib_utils.level_lookup = {level: i for i, level in enumerate(LEVELS)}
+    grib_utils.lat_order = np.arange(len(grib_utils.latitudes))
+    grib_utils.lng_order = np.arange(len(grib_utils.longitudes))
+
+
+# smooth wind fields that change over time
+def synthetic_cube(valid_time):
+    phase = valid_time / (24.0*HOURS_TO_MS)
+    lats = np.radians(grib_utils.latitudes)[None, :, None]
+    lngs = np.radians(grib_utils.longitudes)[None, None, :]
+    levels = np.array(LEVELS, dtype=float)[:, None, None]
+
+    u = 30*np.cos(lats)*(levels / 1000.0) + 10*np.sin(2*lngs + phase)
+    v = 10*np.sin(3*lats + phase)*np.cos(lngs)
+
+    return np.stack(np.broadcast_arrays(u, v)).astype(grib_utils.CUBE_DTYPE)
+
+
+def end_time():
+    return START + (CYCLES - 1)*6*HOURS_TO_MS
+
+
+def random_points(count, seed=0):
+    """
+    Random timestamps (sorted), latitudes, longitudes, and altitudes within the fixture
+    """
+    rng = np.random.default_rng(seed)
+
+    timestamps = np.sort(rng.uniform(START, end_time(), count))
+    lats = rng.uniform(-80, 80, count)
+    lons = rng.uniform(-180, 180, count)
+    altitudes = rng.uniform(8000, 16000, count)
+
+    return timestamps, lats, lons, altitudes
+
+
+def synthetic_track(count, seed=0):
+    """
+    Transmissions of a balloon drifting east across the Atlantic, evenly spread over the time the fixture covers
+    """
+    rng = np.random.default_rng(seed)
+
+    transmissions = empty_columns(count, TRANSMISSION_DTYPE)
+    transmissions['transmit_time'] = np.linspace(START, end_time(), count)
+    transmissions['latitude'] = 40 + np.cumsum(rng.normal(0, 0.01, count))
+    transmissions['longitude'] = -70 + np.cumsum(rng.normal(0.02, 0.01, count))
+    transmissions['altitude_barometer'] = 13000 + np.cumsum(rng.normal(0, 10, count))
+
+    return transmissions
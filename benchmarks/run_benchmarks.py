@@ -0,0 +1,157 @@
+import os
+import sys
+import io
+import json
+import time
+import platform
+import argparse
+import tempfile
+import contextlib
+import subprocess
+from datetime import datetime, timezone
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import numpy as np
+import grib_utils
+import dataset_manager
+import fixture
+from main import compare_transmissions
+
+"""
+Benchmarks of the wind lookups and the analysis, run against the synthetic fixture. Results are written as json, so
+that they can be compared between commits: python benchmarks/run_benchmarks.py --output results.json
+"""
+
+SINGLE_LOOKUPS = 200
+BATCH_LOOKUPS = 10000
+FIND_DATASETS_LOOKUPS = 1000
+TRACK_TRANSMISSIONS = 5000
+
+
+def measure(function, count, repeat=3):
+    """
+    Runs function (which does count operations) repeat times, keeping the fastest run
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        # the code under test prints its progress, which would only slow it down
+        with contextlib.redirect_stdout(io.StringIO()):
+            function()
+        seconds.append(time.perf_counter() - start)
+
+    best = min(seconds)
+    return {
+        'seconds': best,
+        'count': count,
+        'per_second': count / best,
+        'ms_per_1000': 1000.0 * best / count * 1000
+    }
+
+
+def cold(function):
+    # the decoded datasets are still in the os page cache, so this measures the cost of reading them into memory
+    def run():
+        grib_utils.close_open_grib_files(debug=False)
+        function()
+
+    return run
+
+
+def bench_single(points):
+    def run():
+        for point in zip(*[axis[:SINGLE_LOOKUPS] for axis in points]):
+            grib_utils.get_wind_velocity(*point)
+
+    return run
+
+
+def bench_batch(points):
+    return lambda: grib_utils.get_wind_velocities(*points)
+
+
+def bench_find_datasets(timestamps):
+    def run():
+        for timestamp in timestamps[:FIND_DATASETS_LOOKUPS]:
+            dataset_manager.find_datasets(timestamp)
+
+    return run
+
+
+def bench_compare(transmissions):
+    return lambda: compare_transmissions(transmissions)
+
+
+def run_benchmarks():
+    points = fixture.random_points(BATCH_LOOKUPS)
+    transmissions = fixture.synthetic_track(TRACK_TRANSMISSIONS)
+
+    single = bench_single(points)
+    batch = bench_batch(points)
+    compare = bench_compare(transmissions)
+
+    # warm up the caches the warm benchmarks rely on
+    with contextlib.redirect_stdout(io.StringIO()):
+        batch()
+
+    results = {
+        'get_wind_velocity_warm': measure(single, SINGLE_LOOKUPS),
+        'get_wind_velocity_cold': measure(cold(single), SINGLE_LOOKUPS),
+        'get_wind_velocities_warm': measure(batch, BATCH_LOOKUPS),
+        'get_wind_velocities_cold': measure(cold(batch), BATCH_LOOKUPS),
+        'find_datasets': measure(bench_find_datasets(points[0]), FIND_DATASETS_LOOKUPS),
+        'find_datasets_batch': measure(lambda: dataset_manager.find_datasets_batch(points[0]), BATCH_LOOKUPS),
+        'compare_transmissions_warm': measure(compare, TRACK_TRANSMISSIONS),
+        'compare_transmissions_cold': measure(cold(compare), TRACK_TRANSMISSIONS),
+    }
+
+    grib_utils.close_open_grib_files(debug=False)
+
+    return results
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', help='file to write the results to, instead of printing them')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output is not None else None
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        fixture.create_fixture()
+        results = run_benchmarks()
+        os.chdir(ROOT_DIR)
+
+    report = {
+        'commit': get_commit(),
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'fixture': {
+            'datasets': len(dataset_manager.index),
+            'grid_step': fixture.GRID_STEP,
+            'levels': len(fixture.LEVELS)
+        },
+        'benchmarks': results
+    }
+
+    text = json.dumps(report, indent=4)
+    if output is not None:
+        with open(output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import numpy as np
+
+"""
+Transmissions and results are passed between stages as structured NumPy arrays, one field per column. Missing values
+are NaN
+"""
+
+TRANSMISSION_DTYPE = np.dtype([
+    ('transmit_time', 'f8'),  # ms since the epoch
+    ('time', 'f8'),  # seconds since the start of the dataframe, NaN for HABMC transmissions
+    ('latitude', 'f8'),
+    ('longitude', 'f8'),
+    ('altitude_barometer', 'f8'),
+])
+
+RESULT_DTYPE = np.dtype([
+    ('latitude', 'f8'),
+    ('longitude', 'f8'),
+    ('altitude', 'f8'),
+    ('timestamp', 'f8'),
+    ('data_speed', 'f8'),
+    ('speed_upper', 'f8'),
+    ('speed_lower', 'f8'),
+    ('model_speed', 'f8'),
+    ('data_bearing', 'f8'),
+    ('model_bearing', 'f8'),
+    ('data_velocity', 'f8', (2,)),
+    ('model_velocity', 'f8', (2,)),
+    ('speed_error', 'f8'),
+])
+
+
+def empty_columns(length, dtype):
+    columns = np.empty(length, dtype=dtype)
+    for name in dtype.names:
+        columns[name] = np.nan
+
+    return columns
+
+
+def from_records(records, dtype):
+    """
+    Converts a list of dicts (such as parsed json) to columns. Missing keys and None become NaN
+    """
+    columns = empty_columns(len(records), dtype)
+    for name in dtype.names:
+        shape = dtype[name].shape
+        if len(shape) == 0:
+            columns[name] = np.array([record.get(name) for record in records], dtype=float)
+        else:
+            missing = [np.nan] * shape[0]
+            columns[name] = np.array([missing if record.get(name) is None else record[name] for record in records], dtype=float).reshape((len(records),) + shape)
+
+    return columns
+
+
+def to_records(columns):
+    """
+    Converts columns back to a list of dicts, with None for missing values, as written to json
+    """
+    lists = {}
+    for name in columns.dtype.names:
+        values = columns[name]
+        if values.ndim == 1:
+            lists[name] = [None if value != value else value for value in values.tolist()]
+        else:
+            missing = np.isnan(values).all(axis=1).tolist()
+            lists[name] = [None if is_missing else row for is_missing, row in zip(missing, values.tolist())]
+
+    return [dict(zip(lists.keys(), row)) for row in zip(*lists.values())]
+
+
+def transmissions_from_records(records):
+    return from_records(records, TRANSMISSION_DTYPE)
+
+
+def results_from_records(records):
+    return from_records(records, RESULT_DTYPE)
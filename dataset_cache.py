@@ -0,0 +1,103 @@
+import threading
+from collections import OrderedDict
+
+
+class DatasetCache:
+    """
+    Byte-bounded LRU cache of decoded datasets. Datasets are requested in (mostly) increasing time order, so once the
+    budget is exceeded, datasets that are valid before the latest requested time are evicted first, oldest first,
+    before falling back to least recently used. Safe to use from several threads, so that datasets can be loaded in
+    the background.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.entries = OrderedDict()  # key -> (value, nbytes, valid_time)
+        self.resident_bytes = 0
+        self.cursor = None  # latest valid time requested
+        self.lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.loads = 0
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    # accept can reject a cached value that will not do, e.g. one that does not cover enough, which counts as a miss
+    def get(self, key, valid_time=None, accept=None):
+        with self.lock:
+            if valid_time is not None and (self.cursor is None or valid_time > self.cursor):
+                self.cursor = valid_time
+
+            entry = self.entries.get(key)
+            if entry is None or (accept is not None and not accept(entry[0])):
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+
+            return entry[0]
+
+    # unlike get, this does not move the cursor, so datasets can be put in ahead of time
+    def put(self, key, value, nbytes, valid_time=None):
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+
+            self.evict(self.budget - nbytes)
+
+            self.entries[key] = (value, nbytes, valid_time)
+            self.resident_bytes += nbytes
+            self.loads += 1
+
+    def remove(self, key):
+        with self.lock:
+            _, nbytes, _ = self.entries.pop(key)
+            self.resident_bytes -= nbytes
+
+    # evicts entries until at most max_bytes are resident
+    def evict(self, max_bytes):
+        with self.lock:
+            if self.resident_bytes <= max_bytes:
+                return
+
+            behind_cursor = sorted(
+                [(valid_time, key) for key, (_, _, valid_time) in self.entries.items() if valid_time is not None and self.cursor is not None and valid_time < self.cursor],
+                key=lambda entry: entry[0]
+            )
+            candidates = [key for _, key in behind_cursor] + [key for key in self.entries.keys()]
+
+            for key in candidates:
+                if self.resident_bytes <= max_bytes:
+                    break
+
+                if key not in self.entries:
+                    continue
+
+                self.remove(key)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.resident_bytes = 0
+            self.cursor = None
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'loads': self.loads,
+                'hit_rate': self.hits / float(lookups) if lookups > 0 else float('NaN'),
+                'entries': len(self.entries),
+                'resident_bytes': self.resident_bytes,
+                'budget': self.budget
+            }
@@ -1,104 +1,148 @@
-from download_grib import download_dataset
+from download_grib import download_dataset, download_datasets
+from download_utilities import get_session, MAX_CONNECTIONS, TIMEOUT
+from download_habmc_data import download_data_for_mission
+from mission_config import ANALYZED_MISSIONS
 from bs4 import BeautifulSoup
-import requests
+from concurrent.futures import ThreadPoolExecutor
 import re
 import os
 import json
+import sys
 from pathlib import Path
 from datetime import timezone, datetime
-import bisect
+import numpy as np
 
 index = {}
-index_built = False
+# (year, month)s that have been added to the index
+indexed_months = set()
+
+# sorted valid times and urls of the datasets used for lookups, see compile_timeline
+timeline_times = None
+timeline_urls = None
 
 HOURS_TO_MS = 60*60*1000
 
+GFS_BASE_URL = 'https://nomads.ncdc.noaa.gov/data/gfs4/'
+INDEX_DIR = 'data/index'
+LISTINGS_DIR = INDEX_DIR + '/listings'
+
+# datasets bracketing a timestamp can be up to this far away from it, so their months have to be indexed too
+LOOKUP_MARGIN = 6*HOURS_TO_MS
+
 def find_datasets(timestamp):
-    build_index()
+    urls, dataset_times = find_dataset_urls(timestamp)
 
-    selected_datasets = [value for value in index.values() if value['offset'] == 0 or value['offset'] == 3]
-    # selected_datasets = [value for value in index.values() if value['month'] == 10 and value['day'] == 31 and value['hour'] == 6]
-    selected_datasets.sort(key=lambda value: value['timestamp'] + HOURS_TO_MS*value['offset'])
-    timestamps = [value['timestamp'] + HOURS_TO_MS*value['offset'] for value in selected_datasets]
+    return (download_dataset(urls[0]), download_dataset(urls[1])), dataset_times
 
-    timestamp_i = bisect.bisect_right(timestamps, timestamp)
-    lower = selected_datasets[max(timestamp_i - 1, 0)]
-    upper = selected_datasets[min(timestamp_i, len(selected_datasets) - 1)]
+# like find_datasets, but without downloading them
+def find_dataset_urls(timestamp):
+    lower, upper = find_dataset_indices(timestamp)
 
     return (
-               download_dataset(lower['url']),
-               download_dataset(upper['url'])
+               timeline_urls[lower],
+               timeline_urls[upper]
            ), (
-               lower['timestamp'] + HOURS_TO_MS*lower['offset'],
-               upper['timestamp'] + HOURS_TO_MS*upper['offset']
+               timeline_times[lower],
+               timeline_times[upper]
            )
 
-def build_index(debug=True):
-    global index
-    global index_built
+def find_datasets_batch(timestamps):
+    """
+    Batch version of find_datasets. Returns arrays of the lower and upper datasets for each timestamp, along with
+    arrays of their times
+    """
+    lower, upper = find_dataset_indices(timestamps)
 
-    if index_built:
-        return
+    # only download each dataset once, several at a time
+    used = np.unique(np.concatenate([np.ravel(lower), np.ravel(upper)]))
+    paths = np.empty(len(timeline_urls), dtype=object)
+    paths[used] = download_datasets(timeline_urls[used])
 
-    output_dir = 'data/index'
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    return (paths[lower], paths[upper]), (timeline_times[lower], timeline_times[upper])
 
-    output_file = output_dir + '/index.json'
+# indices into the timeline of the datasets before and after each timestamp
+def find_dataset_indices(timestamps):
+    build_index(months=months_between(np.min(timestamps) - LOOKUP_MARGIN, np.max(timestamps) + LOOKUP_MARGIN))
+    compile_timeline()
 
-    if Path(output_file).is_file():
-        with open(output_file) as f:
-            index = json.loads(f.read())
-        index_built = True
+    timestamp_i = np.searchsorted(timeline_times, timestamps, side='right')
+    lower = np.maximum(timestamp_i - 1, 0)
+    upper = np.minimum(timestamp_i, len(timeline_times) - 1)
 
-        if debug:
-            print('\t[DatasetManager] Loaded index from disk')
+    return lower, upper
+
+def compile_timeline():
+    """
+    Compiles the index into arrays of the times and urls of the datasets used for lookups, sorted by time
+    """
+    global timeline_times
+    global timeline_urls
+
+    if timeline_times is not None:
         return
 
-    if debug:
-        print('\t[DatasetManager] Building index')
+    selected_datasets = [value for value in index.values() if value['offset'] == 0 or value['offset'] == 3]
+    # selected_datasets = [value for value in index.values() if value['month'] == 10 and value['day'] == 31 and value['hour'] == 6]
+    times = np.array([value['timestamp'] + HOURS_TO_MS*value['offset'] for value in selected_datasets], dtype=float)
+    urls = np.array([value['url'] for value in selected_datasets], dtype=object)
+
+    order = np.argsort(times, kind='stable')
+    timeline_times = times[order]
+    timeline_urls = urls[order]
+
+# needs to be called whenever the index changes
+def invalidate_timeline():
+    global timeline_times
+    global timeline_urls
+
+    timeline_times = None
+    timeline_urls = None
+
+def build_index(debug=True, months=None, refresh=False):
+    """
+    Makes sure the index covers the given (year, month)s, by default the months spanned by the analyzed missions.
+    Months that have been indexed before are loaded from disk, unless refresh is set, in which case their listings are
+    revalidated with the server
+    """
+    if months is None:
+        months = mission_months()
+
+    missing = [month for month in sorted(set(months)) if refresh or month not in indexed_months]
+    if len(missing) == 0:
+        return
 
-    # TODO: stop hardcoding this
-    build_index_for_month(2017, '04', debug)
-    build_index_for_month(2017, 12, debug)
-    build_index_for_month(2018, 10, debug)
-    build_index_for_month(2018, 11, debug)
+    os.makedirs(INDEX_DIR, exist_ok=True)
 
-    with open(output_file, 'w') as f:
-        f.write(json.dumps(index))
+    if debug:
+        print('\t[DatasetManager] Building index for %s' % ', '.join('%d-%02d' % month for month in missing))
+
+    for year, month in missing:
+        index.update(build_index_for_month(year, month, debug, refresh))
+        indexed_months.add((year, month))
 
-    index_built = True
+    invalidate_timeline()
 
-def build_index_for_month(year, month, debug):
-    output_dir = 'data/index/%s%s' % (year, month)
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+def build_index_for_month(year, month, debug, refresh=False):
+    output_dir = '%s/%d%02d' % (INDEX_DIR, year, month)
+    os.makedirs(output_dir, exist_ok=True)
 
     output_file = output_dir + '/index.json'
 
-    if Path(output_file).is_file():
+    if Path(output_file).is_file() and not refresh:
         with open(output_file) as f:
             contents = json.loads(f.read())
 
-        for key, value in contents.items():
-            index[key] = value
-
         if debug:
-            print('\t\t[DatasetManager] %s-%s already indexed' % (year, month))
+            print('\t\t[DatasetManager] %d-%02d already indexed' % (year, month))
         return contents
 
     if debug:
-        print('\t\t[DatasetManager] Building index for %s-%s' % (year, month))
-
-    url = 'https://nomads.ncdc.noaa.gov/data/gfs4/' + str(year) + str(month) + '/'
+        print('\t\t[DatasetManager] Building index for %d-%02d' % (year, month))
 
-    response = requests.get(url)
-    if response.status_code != 200:
-        print(url)
-        raise Exception('Bad response: %d' % response.status_code)
+    url = '%s%d%02d/' % (GFS_BASE_URL, year, month)
 
-    soup = BeautifulSoup(response.text, 'html.parser')
-    partial_index = {}
+    soup = BeautifulSoup(fetch_listing(url, debug), 'html.parser')
+    days = []
     for link in soup.find_all('a'):
         href = link.get('href')
 
@@ -106,28 +150,29 @@ def build_index_for_month(year, month, debug):
         if not matches:
             continue
 
-        partial_index = {
-            **partial_index,
-            **build_index_for_day(matches.group(1), matches.group(2), matches.group(3), debug)
-        }
+        days.append((matches.group(1), matches.group(2), matches.group(3)))
+
+    # days are independent, so crawl several at a time
+    partial_index = {}
+    with ThreadPoolExecutor(max_workers=MAX_CONNECTIONS) as executor:
+        for day_index in executor.map(lambda day: build_index_for_day(*day, debug, refresh), days):
+            partial_index.update(day_index)
 
     with open(output_file, 'w') as f:
         f.write(json.dumps(partial_index))
 
-def build_index_for_day(year, month, day, debug):
-    output_dir = 'data/index/%s%s/%s' % (year, month, day)
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    return partial_index
+
+def build_index_for_day(year, month, day, debug, refresh=False):
+    output_dir = '%s/%s%s/%s' % (INDEX_DIR, year, month, day)
+    os.makedirs(output_dir, exist_ok=True)
 
     output_file = output_dir + '/index.json'
 
-    if Path(output_file).is_file():
+    if Path(output_file).is_file() and not refresh:
         with open(output_file) as f:
             contents = json.loads(f.read())
 
-        for key, value in contents.items():
-            index[key] = value
-
         if debug:
             print('\t\t\t[DatasetManager] %s-%s-%s already indexed' % (year, month, day))
         return contents
@@ -135,14 +180,9 @@ def build_index_for_day(year, month, day, debug):
     if debug:
         print('\t\t\t[DatasetManager] Building index for %s-%s-%s' % (year, month, day))
 
-    url = 'https://nomads.ncdc.noaa.gov/data/gfs4/' + str(year) + str(month) + '/' + str(year) + str(month) + str(day) + '/'
+    url = GFS_BASE_URL + str(year) + str(month) + '/' + str(year) + str(month) + str(day) + '/'
 
-    response = requests.get(url)
-    if response.status_code != 200:
-        print(url)
-        raise Exception('Bad response: %d' % response.status_code)
-
-    soup = BeautifulSoup(response.text, 'html.parser')
+    soup = BeautifulSoup(fetch_listing(url, debug), 'html.parser')
     partial_index = {}
     for link in soup.find_all('a'):
         href = link.get('href')
@@ -156,7 +196,7 @@ def build_index_for_day(year, month, day, debug):
         timestamp = dt.replace(tzinfo=timezone.utc).timestamp()
 
         full_url = url + href
-        partial_index[full_url] = index[full_url] = {
+        partial_index[full_url] = {
             'url': full_url,
             'year': int(year),
             'month': int(month),
@@ -171,8 +211,75 @@ def build_index_for_day(year, month, day, debug):
 
     return partial_index
 
+def fetch_listing(url, debug):
+    """
+    Gets a directory listing, sending the validators of the last response for it so that the server can answer
+    with a cheap 304 if it has not changed
+    """
+    os.makedirs(LISTINGS_DIR, exist_ok=True)
+    cache_file = '%s/%s.json' % (LISTINGS_DIR, url[len(GFS_BASE_URL):].strip('/').replace('/', '_'))
+
+    cached = None
+    headers = {}
+    if Path(cache_file).is_file():
+        with open(cache_file) as f:
+            cached = json.loads(f.read())
+
+        if cached['etag'] is not None:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified'] is not None:
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    response = get_session().get(url, headers=headers, timeout=TIMEOUT)
+
+    if response.status_code == 304 and cached is not None:
+        if debug:
+            print('\t\t\t[DatasetManager] %s has not changed' % url)
+        return cached['body']
+
+    if response.status_code != 200:
+        print(url)
+        raise Exception('Bad response: %d' % response.status_code)
+
+    with open(cache_file, 'w') as f:
+        f.write(json.dumps({
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'body': response.text
+        }))
+
+    return response.text
+
+# (year, month)s between two timestamps, inclusive
+def months_between(start, end):
+    start = datetime.fromtimestamp(start / 1000.0, tz=timezone.utc)
+    end = datetime.fromtimestamp(end / 1000.0, tz=timezone.utc)
+
+    months = []
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+    return months
+
+# months with datasets needed by the analyzed missions
+def mission_months():
+    months = set()
+    for mission in ANALYZED_MISSIONS.keys():
+        transmissions = download_data_for_mission(mission, debug=False)
+        if len(transmissions) == 0:
+            continue
+
+        months.update(months_between(
+            transmissions[0]['transmit_time'] - LOOKUP_MARGIN,
+            transmissions[-1]['transmit_time'] + LOOKUP_MARGIN
+        ))
+
+    return sorted(months)
+
 def get_sample_dataset():
-    return download_dataset('https://nomads.ncdc.noaa.gov/data/gfs4/201811/20181113/gfs_4_20181113_0000_000.grb2')
+    return download_dataset(GFS_BASE_URL + '201811/20181113/gfs_4_20181113_0000_000.grb2')
 
 if __name__ == "__main__":
-    build_index()
\ No newline at end of file
+    build_index(refresh=len(sys.argv) >= 2 and sys.argv[1] == 'refresh')
\ No newline at end of file
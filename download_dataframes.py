@@ -1,64 +1,106 @@
 import os
 from pathlib import Path
 from download_utilities import download_file
-from numpy_encoder import NumpyEncoder
+from columns import empty_columns, transmissions_from_records, TRANSMISSION_DTYPE
+import numpy as np
 import pandas as pd
 import json
 
 DATA_DIR = 'data/dataframes'
 
+DEFAULT_DOWNSAMPLE = 180
+DOWNSAMPLE = int(os.environ.get('DATAFRAME_DOWNSAMPLE', DEFAULT_DOWNSAMPLE))  # one row is kept out of every DOWNSAMPLE
+CHUNK_SIZE = 1000000  # rows read at a time from dataframes stored in table format
+COLUMNS = ['lat_gps', 'long_gps', 'altitude_barometer']
+
 def directory_for(mission_number):
     return '%s/ssi-%s' % (DATA_DIR, str(mission_number))
 
-def download_dataframe_for_mission(mission_number, debug=True):
+def set_downsample(downsample):
+    global DOWNSAMPLE
+    DOWNSAMPLE = downsample
+
+
+def download_dataframe_for_mission(mission_number, debug=True, downsample=None):
+    downsample = DOWNSAMPLE if downsample is None else downsample
     directory = directory_for(mission_number)
 
     if not os.path.exists(directory):
         os.makedirs(directory)
 
-    data_file = directory + ('/ssi%s-processed.json' % mission_number)
+    # the default factor keeps the original names, so that existing caches are still used
+    suffix = '' if downsample == DEFAULT_DOWNSAMPLE else '-%d' % downsample
+    data_file = directory + ('/ssi%s-processed%s.npy' % (mission_number, suffix))
+    legacy_data_file = directory + ('/ssi%s-processed.json' % mission_number)
 
     if Path(data_file).is_file():
         if debug:
             print('\t\t[Data] Data loading from cache')
 
-        with open(data_file) as f:
+        return np.load(data_file)
+
+    if suffix == '' and Path(legacy_data_file).is_file():
+        if debug:
+            print('\t\t[Data] Data loading from cache (converting from json)')
+
+        with open(legacy_data_file) as f:
             contents = f.read()
 
-        return json.loads(contents)
+        result = transmissions_from_records(json.loads(contents))
+        np.save(data_file, result)
+
+        return result
 
-    df = get_dataframe(mission_number, debug)
+    df = get_dataframe(mission_number, debug, downsample)
     result = process_dataframe(df, debug)
 
-    with open(data_file, 'w') as f:
-        f.write(json.dumps(result, cls=NumpyEncoder))
+    np.save(data_file, result)
 
     return result
 
 
 def process_dataframe(dataframe, debug):
-    result = []
-
+    """
+    Converts every row of an (already downsampled) dataframe to a transmission
+    """
     if debug:
         print('\t\t[Dataset processing] Dataset goes from %s to %s' % (dataframe.index[0], dataframe.index[-1]))
 
-    for i in range(len(dataframe.index)):
-        # downsample further
-        if i % 180 != 0:
-            continue
+    index = pd.DatetimeIndex(dataframe.index)
+    if index.tz is not None:
+        index = index.tz_convert('UTC').tz_localize(None)
+
+    # whole microseconds, as Timestamp.timestamp and Timedelta.total_seconds use
+    microseconds = np.asarray((index - pd.Timestamp(0)) // pd.Timedelta(1, 'us'), dtype=np.int64)
 
-        result.append({
-            'transmit_time': float(dataframe.index[i].timestamp() * 1000.0),
-            'time': float((dataframe.index[i] - dataframe.index[0]).total_seconds()),
-            'latitude': float(dataframe['lat_gps'][i]),
-            'longitude': float(dataframe['long_gps'][i]),
-            'altitude_barometer': float(dataframe['altitude_barometer'][i]),
-        })
+    result = empty_columns(len(dataframe.index), TRANSMISSION_DTYPE)
+    result['transmit_time'] = microseconds / 1e6 * 1000.0
+    result['time'] = (microseconds - microseconds[0]) / 1e6
+    result['latitude'] = dataframe['lat_gps'].to_numpy(dtype=float)
+    result['longitude'] = dataframe['long_gps'].to_numpy(dtype=float)
+    result['altitude_barometer'] = dataframe['altitude_barometer'].to_numpy(dtype=float)
 
     return result
 
 
-def get_dataframe(mission_number, debug):
+def read_dataframe(path, downsample):
+    """
+    Reads one row out of every downsample of the columns that are used. Dataframes stored in table format are read
+    CHUNK_SIZE rows at a time, so they do not have to fit in memory, but fixed format ones can only be read whole
+    """
+    with pd.HDFStore(path, mode='r') as store:
+        key = store.keys()[0]
+        if not store.get_storer(key).is_table:
+            return store.select(key)[COLUMNS].iloc[::downsample]
+
+        # chunks are a multiple of downsample rows long, so that each one starts on a kept row
+        chunk_size = max(CHUNK_SIZE // downsample, 1) * downsample
+        chunks = [chunk.iloc[::downsample] for chunk in store.select(key, columns=COLUMNS, iterator=True, chunksize=chunk_size)]
+
+    return pd.concat(chunks)
+
+
+def get_dataframe(mission_number, debug, downsample=1):
     if debug:
         print('\t[Dataframe Downloader] Downloading data for SSI-%d' % mission_number)
 
@@ -71,7 +113,7 @@ def get_dataframe(mission_number, debug):
     else:
         download_file(dataset_url, output_path, debug)
 
-    df = pd.read_hdf(output_path)
+    df = read_dataframe(output_path, downsample)
 
     if debug:
         print('\t[Dataframe Downloader] Read %s.' % output_path)
@@ -1,26 +1,104 @@
 import os
 from pathlib import Path
-from download_utilities import download_file
+from download_utilities import download_file, download_files, download_ranges, download_text
 
 DATA_DIR = 'data/grib'
 cache = {}
 
-def download_dataset(dataset_url, debug=True):
+# when set, only the messages the analysis needs are downloaded from each dataset, see download_grib_messages
+PARTIAL_DOWNLOADS = os.environ.get('GRIB_PARTIAL_DOWNLOADS', '0') == '1'
+
+INVENTORY_SUFFIX = '.idx'
+# u and v wind on pressure levels, as named in the inventory
+INVENTORY_VARIABLES = ['UGRD', 'VGRD']
+
+def output_path_for(dataset_url):
+    return DATA_DIR + '/' + dataset_url.split('/')[-1]
+
+def download_dataset(dataset_url, debug=True, partial=PARTIAL_DOWNLOADS):
     # avoid calls to disk
     if dataset_url in cache:
        return cache[dataset_url]
 
-    if not os.path.exists(DATA_DIR):
-        os.makedirs(DATA_DIR)
+    os.makedirs(DATA_DIR, exist_ok=True)
 
-    output_path = DATA_DIR + '/' + dataset_url.split('/')[-1]
+    output_path = output_path_for(dataset_url)
     if Path(output_path).is_file():
         if debug:
             print('\t[GRIB Downloader] Already downloaded %s' % dataset_url)
         cache[dataset_url] = output_path
         return output_path
 
-    cache[dataset_url] = download_file(dataset_url, output_path, debug)
+    if partial:
+        cache[dataset_url] = download_grib_messages(dataset_url, output_path, debug)
+    else:
+        cache[dataset_url] = download_file(dataset_url, output_path, debug)
 
     return output_path
 
+# downloads all the given datasets that have not been downloaded yet, several at a time
+def download_datasets(dataset_urls, debug=True, partial=PARTIAL_DOWNLOADS):
+    os.makedirs(DATA_DIR, exist_ok=True)
+
+    missing = sorted(set(url for url in dataset_urls if url not in cache and not Path(output_path_for(url)).is_file()))
+    if len(missing) > 0:
+        if debug:
+            print('\t[GRIB Downloader] Downloading %d datasets' % len(missing))
+
+        download_files([(url, output_path_for(url)) for url in missing], debug=debug,
+                       download=download_grib_messages if partial else download_file)
+
+    return [download_dataset(url, debug=False) for url in dataset_urls]
+
+def download_grib_messages(dataset_url, output_path, debug=True):
+    """
+    Downloads only the u and v pressure level messages of a dataset, using the inventory published next to it to find
+    their byte ranges. The result is a smaller, but still valid, GRIB file
+    """
+    inventory = parse_inventory(download_text(dataset_url + INVENTORY_SUFFIX, debug))
+    ranges = select_message_ranges(inventory)
+
+    if len(ranges) == 0:
+        raise Exception('No wind messages found in the inventory of %s' % dataset_url)
+
+    return download_ranges(dataset_url, ranges, output_path, debug)
+
+def parse_inventory(text):
+    """
+    Parses a wgrib2 style inventory into a list of (byte offset, variable, level), with lines like
+    "12:2846245:d=2018111300:UGRD:250 mb:anl:"
+    """
+    entries = []
+    for line in text.splitlines():
+        fields = line.split(':')
+        if len(fields) < 5:
+            continue
+
+        entries.append((int(fields[1]), fields[3], fields[4]))
+
+    return entries
+
+def select_message_ranges(inventory):
+    """
+    Byte ranges (start, inclusive end, or None for the end of the file) of the messages with u and v on pressure
+    levels, with adjacent ranges merged
+    """
+    offsets = sorted(set(offset for offset, _, _ in inventory))
+    ends = {offset: (next_offset - 1) for offset, next_offset in zip(offsets, offsets[1:])}
+
+    # several fields can share a message (and so an offset), so select by offset
+    selected = sorted(set(
+        offset for offset, variable, level in inventory
+        if variable in INVENTORY_VARIABLES and level.endswith(' mb')
+    ))
+
+    ranges = []
+    for offset in selected:
+        end = ends.get(offset)
+        if len(ranges) > 0 and ranges[-1][1] is not None and ranges[-1][1] + 1 == offset:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((offset, end))
+
+    return ranges
+
@@ -1,16 +1,20 @@
 import os
 from pathlib import Path
-import requests
 import json
+from concurrent.futures import ThreadPoolExecutor
+from columns import transmissions_from_records
+from download_utilities import get_session, with_retries, MAX_CONNECTIONS, TIMEOUT
 
 DATA_DIR = 'data/habmc'
+HABMC_URL = os.environ.get('HABMC_URL', 'https://habmc.stanfordssi.org')
+PAGE_SIZE = 500  # transmissions per page
 
 
 def directory_for(mission_number):
     return '%s/ssi-%s' % (DATA_DIR, str(mission_number))
 
 
-def download_data_for_mission(mission_number, debug=True):
+def download_data_for_mission(mission_number, debug=True, sync=False):
     if debug:
         print('\t[HABMC Downloader] Downloading data for SSI-%d' % mission_number)
 
@@ -21,7 +25,7 @@ def download_data_for_mission(mission_number, debug=True):
 
     mission_id = get_id(mission_number, debug)
 
-    return get_data(mission_number, mission_id, debug)
+    return get_data(mission_number, mission_id, debug, sync)
 
 
 def get_id(mission_number, debug):
@@ -34,7 +38,8 @@ def get_id(mission_number, debug):
             contents = f.read()
         return contents
 
-    data = requests.get('https://habmc.stanfordssi.org/missions.json').json()
+    url = HABMC_URL + '/missions.json'
+    data = with_retries(lambda: get_json(url), url, debug)
 
     mission_id = None
 
@@ -54,50 +59,139 @@ def get_id(mission_number, debug):
     return mission_id
 
 
-def get_data(mission_number, mission_id, debug):
-    data_file = directory_for(mission_number) + '/habmc_data.json'
-    if Path(data_file).is_file():
+def get_data(mission_number, mission_id, debug, sync=False):
+    """
+    Transmissions of a mission, from the cache if there is one. With sync, the transmissions sent since the cache was
+    last updated are downloaded and added to it first
+    """
+    data_file = directory_for(mission_number) + '/habmc_data.jsonl'
+    legacy_data_file = directory_for(mission_number) + '/habmc_data.json'
+
+    if not Path(data_file).is_file() and Path(legacy_data_file).is_file():
+        if debug:
+            print('\t\t[Data] Converting cache from json')
+
+        with open(legacy_data_file) as f:
+            append_data(data_file, json.loads(f.read()))
+
+    data = read_data(data_file)
+    if Path(data_file).is_file() and not sync:
         if debug:
             print('\t\t[Data] Data loading from cache')
 
-        with open(data_file) as f:
-            contents = f.read()
+        return transmissions_from_records(data)
+
+    new_data = download_new_transmissions(mission_id, data, debug)
+    append_data(data_file, new_data)
+
+    print('\t\t[Data] Download complete (%d new transmissions, %d total)' % (len(new_data), len(data) + len(new_data)))
+
+    return transmissions_from_records(data + new_data)
+
+
+# the cache has one transmission per line, sorted by transmit time, so that new ones can be appended to it
+def read_data(data_file):
+    if not Path(data_file).is_file():
+        return []
+
+    with open(data_file) as f:
+        # a line without a newline was cut off while it was written
+        return [json.loads(line) for line in f if line.endswith('\n')]
+
+
+def append_data(data_file, data):
+    with open(data_file, 'ab+') as f:
+        # drop whatever is left of a line that was cut off while it was written
+        size = f.seek(0, os.SEEK_END)
+        if size > 0:
+            f.seek(size - 1)
+            if f.read(1) != b'\n':
+                f.seek(0)
+                f.truncate(f.read().rfind(b'\n') + 1)
+
+        f.write(''.join(json.dumps(transmission) + '\n' for transmission in data).encode())
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def download_new_transmissions(mission_id, known, debug):
+    """
+    Downloads the transmissions sent after the latest known one (known is sorted by transmit time), sorted by transmit
+    time. Which order HABMC pages through transmissions in is not documented, so it is told from the first page: if it
+    starts with a new transmission, pages go newest first, and paging stops at the first page that holds a known
+    transmission. If it starts with the latest known one, pages go newest first and there is nothing new. If it starts
+    with the oldest known one, pages go oldest first, and only the pages after the known transmissions are downloaded
+    """
+    if len(known) == 0:
+        data = download_pages(mission_id, 1, debug)
+    else:
+        latest = known[-1]['transmit_time']
+        has_known = lambda page: any(transmission['transmit_time'] <= latest for transmission in page)
+        has_new = lambda page: any(transmission['transmit_time'] > latest for transmission in page)
+
+        first_page = download_page(mission_id, 1, debug)
+        if len(first_page) == 0:
+            data = []
+        elif first_page[0]['transmit_time'] > latest:
+            # newest first
+            data = first_page if has_known(first_page) else first_page + download_pages(mission_id, 2, debug, has_known)
+        elif first_page[0]['transmit_time'] == latest and not has_new(first_page):
+            # newest first, with nothing new
+            data = []
+        elif first_page[0]['transmit_time'] == known[0]['transmit_time']:
+            # oldest first
+            start = len(known) // PAGE_SIZE + 1
+            data = first_page + download_pages(mission_id, 2, debug) if start == 1 else download_pages(mission_id, start, debug)
+        else:
+            # the pages do not line up with the cache, so look through all of them
+            data = first_page + download_pages(mission_id, 2, debug)
+
+        data = [transmission for transmission in data if transmission['transmit_time'] > latest]
 
-        return json.loads(contents)
+    data.sort(key=lambda transmission: transmission['transmit_time'])
 
-    page = 1
-    limit = 500
-    url = 'https://habmc.stanfordssi.org/missions/%s/transmissions/all.json' % str(mission_id)
+    return data
+
+
+def download_pages(mission_id, start, debug, is_last=None):
+    """
+    Downloads the pages from start until an empty one (or one that is_last), MAX_CONNECTIONS pages at a time
+    """
     data = []
+    page = start
+    with ThreadPoolExecutor(max_workers=MAX_CONNECTIONS) as executor:
+        while True:
+            pages = executor.map(lambda number: download_page(mission_id, number, debug), range(page, page + MAX_CONNECTIONS))
 
-    while True:
-        if debug:
-            print('\t\t[Data] Downloading page %d (limit %d)' % (page, limit))
+            for transmissions in pages:
+                data += transmissions
 
-        response = requests.get(url, params={
-            'page': page,
-            'max': limit
-        }, headers={
-            'Authorization': 'Basic %s' % os.environ['HABMC_KEY']
-        })
+                if len(transmissions) == 0 or (is_last is not None and is_last(transmissions)):
+                    return data
 
-        if response.status_code != 200:
-            print(url)
-            raise Exception('Bad response: %d' % response.status_code)
+            page += MAX_CONNECTIONS
 
-        transmissions = response.json()
-        data += transmissions
 
-        if len(transmissions) == 0:
-            break
+def download_page(mission_id, page, debug):
+    if debug:
+        print('\t\t[Data] Downloading page %d (limit %d)' % (page, PAGE_SIZE))
 
-        page += 1
+    url = '%s/missions/%s/transmissions/all.json' % (HABMC_URL, str(mission_id))
+    params = {
+        'page': page,
+        'max': PAGE_SIZE
+    }
+    headers = {
+        'Authorization': 'Basic %s' % os.environ['HABMC_KEY']
+    }
 
-    print('\t\t[Data] Download complete (%d transmissions)' % len(data))
+    return with_retries(lambda: get_json(url, params, headers), url, debug)
 
-    data.sort(key=lambda transmission: transmission['transmit_time'])
 
-    with open(data_file, 'w') as f:
-        f.write(json.dumps(data))
+# connection errors are retried by with_retries, but bad responses are not
+def get_json(url, params=None, headers=None):
+    response = get_session().get(url, params=params, headers=headers, timeout=TIMEOUT)
+    if response.status_code != 200:
+        raise Exception('Bad response from %s: %d' % (url, response.status_code))
 
-    return data
+    return response.json()
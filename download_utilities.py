@@ -1,41 +1,233 @@
-import subprocess
 import os
+import time
+import fcntl
+import contextlib
+import hashlib
+import threading
+import requests
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
-def download_file(url, output_path, debug=True):
+MAX_CONNECTIONS = 4  # max downloads at once
+MAX_RETRIES = 5
+RETRY_BACKOFF = 2.0  # seconds to wait before the first retry, doubled for each one after that
+TIMEOUT = 60  # seconds without receiving data before a request is abandoned
+CHUNK_BYTES = 256*1024
+
+sessions = threading.local()
+
+
+class IncompleteDownload(Exception):
+    pass
+
+
+# one pooled session per thread, as sessions are not thread safe
+def get_session():
+    if not hasattr(sessions, 'session'):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=MAX_CONNECTIONS, pool_maxsize=MAX_CONNECTIONS)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        sessions.session = session
+
+    return sessions.session
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Holds an exclusive lock on path across processes, and removes the lock file once done. A process that waited on a
+    lock file that was removed in the meantime locks the new one instead
+    """
+    while True:
+        lock = open(path, 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+            current = os.fstat(lock.fileno()).st_ino == os.stat(path).st_ino
+        except FileNotFoundError:
+            current = False
+
+        if current:
+            break
+
+        lock.close()
+
+    try:
+        yield
+    finally:
+        os.remove(path)
+        lock.close()
+
+
+def download_file(url, output_path, debug=True, sha256=None):
+    """
+    Downloads url to output_path, resuming from the .partial file left by an earlier attempt if there is one. Retries
+    with exponential backoff, and checks the size (and sha256, if given) of the result before moving it into place
+    """
     if debug:
         print('\t[Download Utility] Downloading %s to %s' % (url, output_path))
 
+    partial_name = os.path.splitext(output_path)[0] + '.partial'
+
+    # several processes may want the same file at once, so only let one of them download it
+    with file_lock(partial_name + '.lock'):
+        # another process may have finished downloading it while we waited
+        if Path(output_path).is_file():
+            return output_path
+
+        with_retries(lambda: download_partial(url, partial_name, debug), url, debug)
+
+        if sha256 is not None and file_sha256(partial_name) != sha256:
+            os.remove(partial_name)
+            raise Exception('Checksum of %s does not match' % url)
+
+        os.rename(partial_name, output_path)
+
+    if debug:
+        print('\t[Download Utility] Download complete: %s' % output_path)
+
+    return output_path
+
+
+def with_retries(function, url, debug):
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return function()
+        except (requests.RequestException, IncompleteDownload) as e:
+            if attempt == MAX_RETRIES or not is_transient(e):
+                raise
+
+            backoff = RETRY_BACKOFF * 2**attempt
+            if debug:
+                print('\t[Download Utility] Download of %s failed (%s), retrying in %.0fs' % (url, e, backoff))
+            time.sleep(backoff)
+
+
+# connection errors, timeouts, server errors, and cut off downloads may succeed if tried again, client errors will not
+def is_transient(error):
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code >= 500
+
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, IncompleteDownload))
+
+
+def download_partial(url, partial_name, debug):
     remote_bytes = get_remote_bytes(url, debug)
 
+    local_bytes = os.path.getsize(partial_name) if Path(partial_name).is_file() else 0
+    if local_bytes > remote_bytes:
+        # the remote file must have changed, so start over
+        os.remove(partial_name)
+        local_bytes = 0
+
+    if local_bytes == remote_bytes:
+        return
+
     if debug:
-        print('\t[Download Utility] Downloading %d bytes' % remote_bytes)
+        if local_bytes > 0:
+            print('\t[Download Utility] Resuming %s at %d of %d bytes' % (url, local_bytes, remote_bytes))
+        else:
+            print('\t[Download Utility] Downloading %d bytes from %s' % (remote_bytes, url))
 
-    partial_name = output_path.split('.')[0] + '.partial'
+    headers = {'Range': 'bytes=%d-' % local_bytes} if local_bytes > 0 else {}
+    with get_session().get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+        if response.status_code == 206:
+            mode = 'ab'
+        elif response.status_code == 200:
+            # the server ignored the range, so it is sending the whole file again
+            mode = 'wb'
+        else:
+            response.raise_for_status()
+            raise Exception('Bad response: %d' % response.status_code)
 
-    call = subprocess.run(['curl', '-o', partial_name, url])
-    call.check_returncode()
+        with open(partial_name, mode) as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_BYTES):
+                f.write(chunk)
 
     local_bytes = os.path.getsize(partial_name)
-
     if local_bytes != remote_bytes:
-        raise Exception('Local bytes does not match remote bytes')
+        raise IncompleteDownload('Local bytes (%d) does not match remote bytes (%d)' % (local_bytes, remote_bytes))
 
-    os.rename(partial_name, output_path)
 
+def download_ranges(url, ranges, output_path, debug=True):
+    """
+    Downloads only the given (start, end) byte ranges of url, concatenated into output_path. Ends are inclusive, and
+    an end of None means the end of the file
+    """
     if debug:
-        print('\t[Download Utility] Download complete: %s' % output_path)
+        print('\t[Download Utility] Downloading %d ranges of %s to %s' % (len(ranges), url, output_path))
+
+    partial_name = os.path.splitext(output_path)[0] + '.partial'
+
+    with file_lock(partial_name + '.lock'):
+        if Path(output_path).is_file():
+            return output_path
+
+        with open(partial_name, 'wb') as f:
+            for start, end in ranges:
+                f.write(with_retries(lambda: download_range(url, start, end), url, debug))
+
+        os.rename(partial_name, output_path)
+
+    if debug:
+        print('\t[Download Utility] Download complete: %s (%d bytes)' % (output_path, os.path.getsize(output_path)))
 
     return output_path
 
+
+def download_range(url, start, end):
+    headers = {'Range': 'bytes=%d-%s' % (start, '' if end is None else end)}
+    response = get_session().get(url, headers=headers, timeout=TIMEOUT)
+    if response.status_code != 206:
+        response.raise_for_status()
+        raise Exception('Server does not support range requests: %d' % response.status_code)
+
+    if end is None:
+        expected_bytes = int(response.headers['Content-Range'].split('/')[-1]) - start
+    else:
+        expected_bytes = end - start + 1
+
+    if len(response.content) != expected_bytes:
+        raise IncompleteDownload('Received %d bytes instead of %d' % (len(response.content), expected_bytes))
+
+    return response.content
+
+
+def download_text(url, debug=True):
+    def download():
+        response = get_session().get(url, timeout=TIMEOUT)
+        response.raise_for_status()
+        return response.text
+
+    return with_retries(download, url, debug)
+
+
+def download_files(downloads, max_connections=MAX_CONNECTIONS, debug=True, download=download_file):
+    """
+    Downloads a list of (url, output_path) concurrently, with at most max_connections at once. download can be
+    swapped for another function with the same arguments as download_file
+    """
+    with ThreadPoolExecutor(max_workers=max_connections) as executor:
+        futures = [executor.submit(download, url, output_path, debug) for url, output_path in downloads]
+
+    return [future.result() for future in futures]
+
+
 def get_remote_bytes(dataset_url, _debug):
-    call = subprocess.run(['curl', '-I', dataset_url], stdout=subprocess.PIPE)
-    call.check_returncode()
-    lines = call.stdout.decode('utf-8').split("\n")
+    response = get_session().head(dataset_url, allow_redirects=True, timeout=TIMEOUT)
+    response.raise_for_status()
+
+    if 'Content-Length' not in response.headers:
+        raise Exception('Could not find the number of remote bytes')
+
+    return int(response.headers['Content-Length'])
 
-    for line in lines:
-        if not line.startswith('Content-Length:'):
-            continue
 
-        return int(line.split(': ')[-1])
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_BYTES), b''):
+            digest.update(chunk)
 
-    raise Exception('Could not find the number of remote bytes')
\ No newline at end of file
+    return digest.hexdigest()
@@ -1,167 +1,529 @@
 import pygrib
-import bisect
 import numpy as np
-import math
-from dataset_manager import find_datasets, get_sample_dataset
+import os
+import sys
+import threading
+import concurrent.futures
+import dataset_manager
+from dataset_cache import DatasetCache
+from dataset_manager import find_datasets_batch, find_dataset_indices, get_sample_dataset
+from download_grib import DATA_DIR, download_dataset, output_path_for
 
 """
 Major credits to https://github.com/stanford-ssi/valbal-trajectory/blob/master/atmo/atmotools.py, where much of this
 code was adapted from
 """
 
-opened_cache = {}
-cache = {}
+# max bytes of decoded datasets to keep in memory at once
+CACHE_BUDGET = int(os.environ.get('GRIB_CACHE_BUDGET', 1024*1024*1024))
+
+# (region, decoded u/v cube) by dataset, see load_cube
+cubes = DatasetCache(CACHE_BUDGET)
 
 latitudes = None
 longitudes = None
 levels = None
 
-cache_hits = 0
-call_count = 0
+# level -> index into levels
+level_lookup = None
+# orders that sort the native grib latitudes and longitudes into the ascending latitudes and longitudes axes
+lat_order = None
+lng_order = None
 
 NAMES = ['u', 'v']
+CUBE_DTYPE = np.float32
+
+# number of datasets to download and decode in the background ahead of the ones being looked up, see plan_lookups
+PREFETCH_DEPTH = int(os.environ.get('GRIB_PREFETCH_DEPTH', 2))
+
+# resolution in meters of the altitude -> level table used by get_level_bounds, or 0 to compute the levels of every
+# altitude exactly
+LEVEL_TABLE_RESOLUTION = float(os.environ.get('GRIB_LEVEL_TABLE_RESOLUTION', 0))
+# altitudes covered by the level table
+LEVEL_TABLE_RANGE = (-1000, 40000)
+# (lower level indices, upper level indices, level percents) of evenly spaced altitudes, see get_level_table
+level_table = None
+
+# dataset -> region of it that the planned lookups need
+planned_regions = {}
+
+# (dataset, url, valid time) of the datasets the coming lookups need, in the order they will be needed
+prefetch_plan = []
+# dataset -> position in prefetch_plan
+prefetch_positions = {}
+# dataset -> future of the background load of it
+prefetching = {}
+prefetch_lock = threading.Lock()
+prefetch_executor = None
+
+# drops all decoded datasets
+def close_open_grib_files(debug=True):
+    stop_prefetching()
+
+    if debug:
+        print('\t[GRIB] Cache stats: %s' % format_cache_stats())
+
+    cubes.clear()
 
-# closes all open grib files
-def close_open_grib_files():
-    global opened_cache
 
-    for grb in opened_cache.values():
-        grb.close()
+def set_cache_budget(budget):
+    cubes.budget = budget
+    cubes.evict(budget)
 
-    opened_cache = {}
+
+def get_cache_stats():
+    return cubes.stats()
+
+
+def format_cache_stats():
+    stats = cubes.stats()
+    return 'hit rate: %f, hits: %d, misses: %d, loads: %d, evictions: %d, resident: %.1f/%.1f MB (%d datasets)' % (
+        stats['hit_rate'], stats['hits'], stats['misses'], stats['loads'], stats['evictions'],
+        stats['resident_bytes'] / 1e6, stats['budget'] / 1e6, stats['entries']
+    )
 
 
 def get_wind_velocity(timestamp, latitude, longitude, altitude):
-    datasets, dataset_times = find_datasets(timestamp)
-    dataset_1, dataset_2 = datasets
-    time_1, time_2 = dataset_times
-
-    lat_lower, lng_lower, level_lower, lat_upper, lng_upper, level_upper = get_aligned_bounds(latitude, longitude, altitude)
-    positions = [
-        (lat_lower, lng_lower, level_lower), # 0: 000
-        (lat_lower, lng_lower, level_upper), # 1: 001
-        (lat_lower, lng_upper, level_lower), # 2: 010
-        (lat_lower, lng_upper, level_upper), # 3: 011
-        (lat_upper, lng_lower, level_lower), # 4: 100
-        (lat_upper, lng_lower, level_upper), # 5: 101
-        (lat_upper, lng_upper, level_lower), # 6: 110
-        (lat_upper, lng_upper, level_upper), # 7: 111
-    ]
-
-    values1 = [get_uv_aligned(dataset_1, lat, lng, level) for lat, lng, level in positions]
-    values2 = [get_uv_aligned(dataset_2, lat, lng, level) for lat, lng, level in positions]
-
-    # interpolate within each dataset
-    percent_lat = calc_percent(latitude, lat_lower, lat_upper)
-    percent_lng = calc_percent(longitude + 180, lng_lower, lng_upper)
-    percent_lev = calc_percent(altitude_to_hpa(altitude), level_lower, level_upper)
-
-    velocities = []
-    for values in [values1, values2]:
-        vel = (
-            percent_lat * (
-                percent_lng * (
-                    percent_lev*values[0b000] + (1.0-percent_lev)*values[0b001]
-                ) +
-                (1.0 - percent_lng) * (
-                    percent_lev*values[0b010] + (1.0-percent_lev)*values[0b011]
-                )
+    return get_wind_velocities([timestamp], [latitude], [longitude], [altitude])[0]
+
+
+# bits of each corner of a cell: lat, lng, level (0 -> lower, 1 -> upper), so corner 0b011 is at the lower latitude and
+# the upper longitude and level
+CORNERS = np.array([[(corner >> 2) & 1, (corner >> 1) & 1, corner & 1] for corner in range(8)], dtype=bool)
+
+def get_wind_velocities(timestamps, lats, lons, altitudes):
+    """
+    Takes arrays of points and returns an (N, 2) array of the u, v velocities at them
+    """
+    timestamps = np.asarray(timestamps, dtype=float)
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    altitudes = np.asarray(altitudes, dtype=float)
+
+    if len(timestamps) == 0:
+        return np.zeros((0, len(NAMES)))
+
+    (datasets_1, datasets_2), (times_1, times_2) = find_datasets_batch(timestamps)
+
+    corner_indices, percents = get_stencil(lats, lons, altitudes)
+
+    # (8, N, 2) values of each corner, for each of the bracketing datasets
+    values1 = np.empty((len(CORNERS), len(timestamps), len(NAMES)))
+    values2 = np.empty((len(CORNERS), len(timestamps), len(NAMES)))
+
+    # go dataset by dataset in time order so each one is only loaded once
+    all_datasets = np.concatenate([datasets_1, datasets_2])
+    all_times = np.concatenate([times_1, times_2])
+    unique_datasets, first_seen = np.unique(all_datasets, return_index=True)
+    for dataset_i in np.argsort(all_times[first_seen], kind='stable'):
+        dataset = unique_datasets[dataset_i]
+        in_1 = datasets_1 == dataset
+        in_2 = datasets_2 == dataset
+        used = in_1 | in_2
+
+        # start loading the next datasets while this one is being loaded and interpolated
+        prefetch_after(dataset)
+
+        values = get_uv_indexed(dataset, *[indices[used] for indices in corner_indices], valid_time=all_times[first_seen[dataset_i]]).transpose(1, 0, 2)
+        values1[:, in_1] = values[:, in_1[used]]
+        values2[:, in_2] = values[:, in_2[used]]
+
+    percent_lat, percent_lng, percent_lev = [percent[:, None] for percent in percents]
+    velocities1 = interpolate_trilinear(values1, percent_lat, percent_lng, percent_lev)
+    velocities2 = interpolate_trilinear(values2, percent_lat, percent_lng, percent_lev)
+
+    # and interpolate by time
+    percent_time = calc_percents(timestamps, times_1, times_2)[:, None]
+
+    return percent_time*velocities1 + (1.0 - percent_time)*velocities2
+
+
+def interpolate_trilinear(values, percent_lat, percent_lng, percent_lev):
+    """
+    Interpolates between the 8 corners of a cell, indexed in the same order as CORNERS
+    """
+    return (
+        percent_lat * (
+            percent_lng * (
+                percent_lev*values[0b000] + (1.0-percent_lev)*values[0b001]
             ) +
-            (1.0 - percent_lat) * (
-                percent_lng * (
-                    percent_lev*values[0b100] + (1.0-percent_lev)*values[0b101]
-                ) +
-                (1.0 - percent_lng) * (
-                    percent_lev*values[0b110] + (1.0-percent_lev)*values[0b111]
-                )
+            (1.0 - percent_lng) * (
+                percent_lev*values[0b010] + (1.0-percent_lev)*values[0b011]
+            )
+        ) +
+        (1.0 - percent_lat) * (
+            percent_lng * (
+                percent_lev*values[0b100] + (1.0-percent_lev)*values[0b101]
+            ) +
+            (1.0 - percent_lng) * (
+                percent_lev*values[0b110] + (1.0-percent_lev)*values[0b111]
             )
         )
-        velocities.append(vel)
+    )
+
+def get_uv_indexed(dataset, lat_indices, lng_indices, level_indices, valid_time=None):
+    """
+    Gets u, v for arrays of grid indices, returning an array of shape (*indices.shape, 2)
+    """
+    region, cube = load_cube(dataset, valid_time, region_of(level_indices, lat_indices, lng_indices))
+    (level_start, _), (lat_start, _), (lng_start, _) = region
+
+    return np.moveaxis(np.asarray(cube[:, level_indices - level_start, lat_indices - lat_start, lng_indices - lng_start], dtype=float), 0, -1)
+
+
+def load_cube(dataset, valid_time=None, region=None):
+    """
+    Gets the u/v values of (a region of) a dataset as a float32 array of shape (2, level, lat, lon), indexed in the same
+    order as the NAMES, levels, latitudes, and longitudes axes. Returns the region that was loaded along with the array.
+    This covers at least the requested region (by default the whole dataset) and the region planned for the dataset
+    by plan_lookups, or the whole dataset if it was not planned
+    """
+    if region is None:
+        region = full_region()
+
+    # if it is being loaded in the background, wait for that rather than loading it twice
+    with prefetch_lock:
+        future = prefetching.get(dataset)
+    if future is not None:
+        concurrent.futures.wait([future])
+
+    cached_regions = []
+    def covers(entry):
+        cached_regions.append(entry[0])
+        return region_contains(entry[0], region)
+
+    entry = cubes.get(dataset, valid_time, covers)
+    if entry is not None:
+        return entry
+
+    print('\t[GRIB] Cache miss for %s (%s)' % (dataset.split('/')[-1], format_cache_stats()))
+
+    # only the planned region is needed, unless the lookups stray outside of it. In that case load everything that
+    # was cached before as well, so that they do not keep reloading it
+    planned_region = planned_regions.get(dataset)
+    if planned_region is None:
+        region = full_region()
+    else:
+        region = region_union(region, planned_region)
+        for cached_region in cached_regions:
+            region = region_union(region, cached_region)
 
-    # and interpolate by time
-    percent_time = calc_percent(timestamp, time_1, time_2)
+    entry = (region, read_region(dataset, region))
+    cubes.put(dataset, entry, entry[1].nbytes, valid_time)
 
-    return percent_time*velocities[0] + (1.0 - percent_time)*velocities[1]
+    return entry
 
-# Empirically determined constant for how much data should be preloaded at a time
-PRELOAD_RANGE = 20
 
-def get_uv_aligned(dataset, latitude, longitude, level):
-    global call_count
-    global cache_hits
-    global cache
+def read_region(dataset, region):
+    cube = read_sidecar(dataset)
+    if cube is None:
+        cube = decode_cube(dataset)
+        write_sidecar(dataset, cube)
 
-    call_count += 1
+    if region == full_region():
+        return cube
 
-    values = []
-    miss = False
-    for name in NAMES:
-        found = cache.get((dataset, latitude, longitude, level, name))
-        if found is None:
-            miss = True
-            break
-        else:
-            values.append(found)
+    (level_start, level_stop), (lat_start, lat_stop), (lng_start, lng_stop) = region
+    return np.array(cube[:, level_start:level_stop, lat_start:lat_stop, lng_start:lng_stop])
 
-    if miss:
-        print('\t[GRIB] Cache miss (hit rate: %f, calls: %d, hits: %d) for (%f, %f, %f, %s)' % ((cache_hits/(call_count + 1)), call_count, cache_hits, latitude, longitude, level, dataset.split('/')[-1]))
-    else:
-        cache_hits += 1
-        return np.array(values)
 
-    if dataset in opened_cache:
-        grbs = opened_cache[dataset]
-    else:
-        grbs = pygrib.open(dataset)
-        opened_cache[dataset] = grbs
+# regions of a dataset are ((level start, stop), (lat start, stop), (lng start, stop)) ranges of grid indices
+def full_region():
+    find_grib_params()
+
+    return (0, len(levels)), (0, len(latitudes)), (0, len(longitudes))
+
+
+# smallest region covering the given grid indices
+def region_of(level_indices, lat_indices, lng_indices):
+    return tuple((int(np.min(indices)), int(np.max(indices)) + 1) for indices in [level_indices, lat_indices, lng_indices])
+
+
+def region_union(region, other):
+    if other is None:
+        return region
+
+    return tuple((min(a[0], b[0]), max(a[1], b[1])) for a, b in zip(region, other))
+
+
+def region_contains(region, other):
+    return all(a[0] <= b[0] and b[1] <= a[1] for a, b in zip(region, other))
+
+
+def plan_lookups(timestamps, lats, lons, altitudes):
+    """
+    Sets the points that are about to be looked up, in any order. The datasets they need are then loaded in the
+    background just before they are needed, and only the region of each dataset that the points need is loaded
+    """
+    global prefetch_plan
+    global prefetch_positions
+    global planned_regions
+
+    prefetch_plan = []
+    prefetch_positions = {}
+    planned_regions = {}
+
+    if len(timestamps) == 0:
+        return
+
+    lower_datasets, upper_datasets = find_dataset_indices(np.asarray(timestamps, dtype=float))
+    corner_indices, _ = get_stencil(np.asarray(lats, dtype=float), np.asarray(lons, dtype=float), np.asarray(altitudes, dtype=float))
+
+    # bounding box of the cells of the points that use each dataset, with each point counted for both of its datasets
+    datasets = np.concatenate([lower_datasets, upper_datasets])
+    order = np.argsort(datasets, kind='stable')
+    used, starts = np.unique(datasets[order], return_index=True)
+
+    # the axes of the regions are ordered level, lat, lng
+    starts_by_axis = [np.minimum.reduceat(np.tile(corner_indices[axis].min(axis=1), 2)[order], starts) for axis in [2, 0, 1]]
+    stops_by_axis = [np.maximum.reduceat(np.tile(corner_indices[axis].max(axis=1), 2)[order], starts) + 1 for axis in [2, 0, 1]]
+
+    # the timeline is sorted by time, so sorted indices are in the order the datasets will be needed
+    for i, timeline_i in enumerate(used):
+        dataset = output_path_for(dataset_manager.timeline_urls[timeline_i])
+        planned_regions[dataset] = tuple((int(axis_starts[i]), int(axis_stops[i])) for axis_starts, axis_stops in zip(starts_by_axis, stops_by_axis))
+
+        if PREFETCH_DEPTH > 0:
+            prefetch_positions[dataset] = len(prefetch_plan)
+            prefetch_plan.append((dataset, dataset_manager.timeline_urls[timeline_i], dataset_manager.timeline_times[timeline_i]))
+
+
+def prefetch_after(dataset):
+    """
+    Starts loading the PREFETCH_DEPTH planned datasets after the given one in the background
+    """
+    global prefetch_executor
+
+    position = prefetch_positions.get(dataset)
+    if position is None:
+        return
+
+    for next_dataset, url, valid_time in prefetch_plan[position + 1:position + 1 + PREFETCH_DEPTH]:
+        with prefetch_lock:
+            if next_dataset in prefetching or next_dataset in cubes:
+                continue
+
+            if prefetch_executor is None:
+                prefetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=PREFETCH_DEPTH)
+
+            prefetching[next_dataset] = prefetch_executor.submit(prefetch_cube, next_dataset, url, valid_time)
+
+
+def prefetch_cube(dataset, url, valid_time):
+    try:
+        download_dataset(url, debug=False)
 
-    for name in NAMES:
-        for i, grb in enumerate(grbs.select(shortName=name,typeOfLevel='isobaricInhPa',level=levels)):
-            data = grb.data(latitude - PRELOAD_RANGE, latitude + PRELOAD_RANGE, longitude - PRELOAD_RANGE, longitude + PRELOAD_RANGE)
+        region = planned_regions.get(dataset, full_region())
+        cube = read_region(dataset, region)
+        if region == full_region():
+            # read it into memory now rather than on first use
+            cube = np.array(cube)
 
-            data_values = data[0].flatten()
-            data_latitudes = data[1].flatten()
-            data_longitudes = data[2].flatten()
+        cubes.put(dataset, (region, cube), cube.nbytes, valid_time)
+    except Exception as e:
+        # it will be loaded again when it is needed, which will report the error
+        print('\t[GRIB] Could not prefetch %s: %s' % (dataset.split('/')[-1], e))
+    finally:
+        with prefetch_lock:
+            del prefetching[dataset]
 
-            for j in range(len(data_values)):
-                data_val = data_values[j]
-                data_lat = data_latitudes[j]
-                data_lng = data_longitudes[j]
 
-                cache[(dataset, data_lat, data_lng, levels[i], name)] = data_val
+# waits for background loads to finish and forgets the planned lookups
+def stop_prefetching():
+    global prefetch_plan
+    global prefetch_positions
+    global planned_regions
 
-    result = np.array([ cache[(dataset, latitude, longitude, level, name)] for name in NAMES])
+    prefetch_plan = []
+    prefetch_positions = {}
+    planned_regions = {}
 
-    return result
+    with prefetch_lock:
+        futures = list(prefetching.values())
+    concurrent.futures.wait(futures)
 
 
-def get_aligned_bounds(latitude, longitude, altitude):
+def decode_cube(dataset):
     find_grib_params()
 
-    global latitudes
-    global longitudes
-    global levels
+    cube = np.full(cube_shape(), np.nan, dtype=CUBE_DTYPE)
+
+    grbs = pygrib.open(dataset)
+    for name_i, name in enumerate(NAMES):
+        for grb in grbs.select(shortName=name, typeOfLevel='isobaricInhPa', level=levels):
+            cube[name_i, level_lookup[grb.level]] = grb.values[np.ix_(lat_order, lng_order)]
+    grbs.close()
+
+    return cube
+
+
+# decoded cubes are stored next to their grib file, so they only ever need to be decoded once
+def sidecar_path(dataset):
+    return dataset.rsplit('.grb2', 1)[0] + '.uv.npy'
+
+
+def read_sidecar(dataset):
+    path = sidecar_path(dataset)
+    if not os.path.isfile(path):
+        return None
+
+    cube = np.load(path, mmap_mode='r')
+    if cube.shape != cube_shape() or cube.dtype != CUBE_DTYPE:
+        print('\t[GRIB] Ignoring stale decoded dataset %s' % path)
+        return None
+
+    return cube
+
+
+def write_sidecar(dataset, cube):
+    path = sidecar_path(dataset)
+
+    # write to a temporary file first so that a partially written file is never read
+    partial_path = '%s.%d.partial' % (path, os.getpid())
+    with open(partial_path, 'wb') as f:
+        np.save(f, cube)
+    os.replace(partial_path, path)
+
+
+# decodes every downloaded grib file that has not been decoded yet
+def convert_grib_files(directory=DATA_DIR, debug=True):
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.grb2'):
+            continue
+
+        dataset = directory + '/' + filename
+        if read_sidecar(dataset) is not None:
+            continue
+
+        if debug:
+            print('\t[GRIB] Decoding %s' % filename)
+
+        write_sidecar(dataset, decode_cube(dataset))
+
+
+def cube_shape():
+    find_grib_params()
+
+    return len(NAMES), len(levels), len(latitudes), len(longitudes)
+
+
+# size in memory of a single decoded dataset
+def cube_nbytes():
+    return int(np.prod(cube_shape())) * np.dtype(CUBE_DTYPE).itemsize
+
+
+def get_stencil(lats, lons, altitudes):
+    """
+    Finds the cell of the grid around each of a batch of points. Returns (N, 8) arrays of the lat, lng, and level
+    indices of the corners of each cell, in the order of CORNERS, along with the (lat, lng, level) interpolation
+    percents of each point. The same stencil serves u and v and both of the datasets around each point
+    """
+    find_grib_params()
+
+    # longitudes wrap around, so points past the last grid longitude are between it and the first one
+    lng_bounds = wrapped_bounds if longitudes_wrap() else clamped_bounds
+
+    corner_indices = []
+    percents = []
+    for axis, values, bounds in [(latitudes, lats, clamped_bounds), (longitudes, np.mod(lons + 180, 360), lng_bounds)]:
+        lower_i, upper_i, lower_values, upper_values = bounds(axis, values)
+
+        corner_indices.append((lower_i, upper_i))
+        percents.append(calc_percents(values, lower_values, upper_values))
 
-    lat_i = bisect.bisect_right(latitudes, latitude)
-    lng_i = bisect.bisect_right(longitudes, longitude + 180)
-    level_i = bisect.bisect_right(levels, altitude_to_hpa(altitude))
+    lower_i, upper_i, level_percents = get_level_bounds(altitudes)
+    corner_indices.append((lower_i, upper_i))
+    percents.append(level_percents)
 
-    lat_lower = latitudes[max(lat_i - 1, 0)]
-    lat_upper = latitudes[min(lat_i, len(latitudes) - 1)]
+    # (N, 8) index arrays of every corner of the surrounding cell
+    corner_indices = [np.where(CORNERS[:, axis], upper_i[:, None], lower_i[:, None]) for axis, (lower_i, upper_i) in enumerate(corner_indices)]
 
-    lng_lower = longitudes[max(lng_i - 1, 0)]
-    lng_upper = longitudes[min(lng_i, len(longitudes) - 1)]
+    return corner_indices, percents
 
-    level_lower = levels[max(level_i - 1, 0)]
-    level_upper = levels[min(level_i, len(levels) - 1)]
 
-    return lat_lower, lng_lower, level_lower, lat_upper, lng_upper, level_upper
+def get_level_bounds(altitudes):
+    """
+    Lower and upper level indices and level interpolation percents of an array of altitudes. If there is a level
+    table, altitudes are rounded to its resolution and looked up in it instead
+    """
+    if LEVEL_TABLE_RESOLUTION <= 0:
+        return compute_level_bounds(altitudes)
+
+    table = get_level_table()
+
+    with np.errstate(invalid='ignore'):
+        rows = np.rint((altitudes - LEVEL_TABLE_RANGE[0]) / LEVEL_TABLE_RESOLUTION)
+    in_table = (rows >= 0) & (rows < len(table[0]))
+
+    bounds = [column[np.where(in_table, rows, 0).astype(int)] for column in table]
+
+    # altitudes outside of the table are computed exactly
+    if not np.all(in_table):
+        for column, exact in zip(bounds, compute_level_bounds(altitudes[~in_table])):
+            column[~in_table] = exact
+
+    return tuple(bounds)
+
+
+def compute_level_bounds(altitudes):
+    hpas = altitudes_to_hpa(altitudes)
+    lower_i, upper_i, lower_values, upper_values = clamped_bounds(np.asarray(levels), hpas)
+
+    return lower_i, upper_i, calc_percents(hpas, lower_values, upper_values)
+
+
+# the level bounds of evenly spaced altitudes, see get_level_bounds
+def get_level_table():
+    global level_table
+
+    if level_table is None:
+        find_grib_params()
+
+        count = int((LEVEL_TABLE_RANGE[1] - LEVEL_TABLE_RANGE[0]) / LEVEL_TABLE_RESOLUTION) + 1
+        level_table = compute_level_bounds(LEVEL_TABLE_RANGE[0] + np.arange(count) * LEVEL_TABLE_RESOLUTION)
+
+    return level_table
+
+
+def set_level_table_resolution(resolution):
+    global LEVEL_TABLE_RESOLUTION
+    global level_table
+
+    LEVEL_TABLE_RESOLUTION = resolution
+    level_table = None
+
+
+# indices and values of the grid points on either side of each value, repeating the first or last one past the ends
+def clamped_bounds(axis, values):
+    i = np.searchsorted(axis, values, side='right')
+    lower_i = np.maximum(i - 1, 0)
+    upper_i = np.minimum(i, len(axis) - 1)
+
+    return lower_i, upper_i, axis[lower_i], axis[upper_i]
+
+
+# like clamped_bounds, but for an axis of degrees where the last point is followed by the first one, 360 degrees on
+def wrapped_bounds(axis, values):
+    i = np.searchsorted(axis, values, side='right')
+    lower_i = (i - 1) % len(axis)
+    upper_i = i % len(axis)
+
+    return lower_i, upper_i, axis[lower_i] - 360.0*(i == 0), axis[upper_i] + 360.0*(i == len(axis))
+
+
+# whether the longitudes go all the way around the globe
+def longitudes_wrap():
+    step = longitudes[1] - longitudes[0]
+    return abs(longitudes[-1] + step - longitudes[0] - 360.0) < step / 2
 
 
 def find_grib_params(shortname='u'):
     global latitudes
     global longitudes
     global levels
+    global level_lookup
+    global lat_order
+    global lng_order
 
     if latitudes is not None and longitudes is not None and levels is not None:
         return
@@ -169,11 +531,11 @@ def find_grib_params(shortname='u'):
     source = get_sample_dataset()
     grb = pygrib.open(source)
     lats,lons = grb.select(shortName=shortname,typeOfLevel='isobaricInhPa',level=250)[0].latlons() # arbitrary data, doing this for latlons
-    latitudes = lats[:,0]
-    longitudes = lons[0,:]
 
-    latitudes.sort()
-    longitudes.sort()
+    lat_order = np.argsort(lats[:,0])
+    lng_order = np.argsort(lons[0,:])
+    latitudes = lats[lat_order,0]
+    longitudes = lons[0,lng_order]
 
     levels = []
     for message in grb:
@@ -187,26 +549,39 @@ def find_grib_params(shortname='u'):
 
             levels.append(message.level)
     levels.sort()
+    level_lookup = {level: i for i, level in enumerate(levels)}
 
     grb.close()
 
 # 1.0 -> all lower, 0.0 -> all upper
-def calc_percent(value, lower, upper):
-    if lower == upper:
-        return 0
+def calc_percents(values, lower, upper):
+    span = upper - lower
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percents = 1.0 - np.clip((values - lower) / span, 0.0, 1.0)
 
-    # note that we invert these percentages cause I don't wanna rewrite the interpolation code
-    return 1.0 - min(max((value - lower) / (upper - lower), 0.0), 1.0)
+    return np.where(span == 0, 0.0, percents)
 
 def altitude_to_hpa(altitude):
+    return float(altitudes_to_hpa(altitude))
+
+# pressure at each altitude, in a standard atmosphere
+def altitudes_to_hpa(altitudes):
+    altitudes = np.asarray(altitudes, dtype=float)
+
     pa_to_hpa = 1.0/100.0
-    if altitude < 11000:
-        return pa_to_hpa * math.exp(math.log(1.0 - (altitude/44330.7)) / 0.190266) * 101325.0
-    else:
-        return pa_to_hpa * math.exp(altitude / -6341.73) * 22632.1 / 0.176481
+    with np.errstate(invalid='ignore'):
+        troposphere = pa_to_hpa * np.exp(np.log(1.0 - (altitudes/44330.7)) / 0.190266) * 101325.0
+    stratosphere = pa_to_hpa * np.exp(altitudes / -6341.73) * 22632.1 / 0.176481
+
+    return np.where(altitudes < 11000, troposphere, stratosphere)
 
 
 if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == 'convert':
+        convert_grib_files()
+        sys.exit()
+
     model_velocity = get_wind_velocity(1541001505000, 49.1123, -40.8999, 13898.9)
     model_speed = float(np.linalg.norm(model_velocity))
 
@@ -0,0 +1,145 @@
+import math
+import numpy as np
+
+"""
+Vectorized kinematics of a whole track at once, computing the same values (down to the last bit) as the per pair
+distance_between did
+"""
+
+MAX_COMM_GAP = 10*60*1000  # max time between transmissions
+
+EARTH_RADIUS = 6371000
+DEG_TO_RAD = math.pi / 180
+
+# one row per transmission after the first, describing the movement from the transmission before it
+KINEMATICS_DTYPE = np.dtype([
+    ('comparable', '?'),
+    ('delta_ms', 'f8'),
+    ('data_velocity', 'f8', (2,)),
+    ('data_speed', 'f8'),
+    ('speed_upper', 'f8'),
+    ('speed_lower', 'f8'),
+    ('data_bearing', 'f8'),
+])
+
+# np.arctan2 can differ from math.atan2 in the last bit, so call the latter to keep results identical
+libm_atan2 = np.frompyfunc(math.atan2, 2, 1)
+
+
+def atan2(y, x):
+    return libm_atan2(y, x).astype(float)
+
+
+def norm(vectors):
+    """
+    Length of each row of an (n, 2) array. Rounds the same way as np.linalg.norm on a single vector
+    """
+    return np.sqrt((vectors[:, None, :] @ vectors[:, :, None])[:, 0, 0])
+
+
+def distance_between(lat1, lng1, lat2, lng2):
+    """
+    Displacement vectors, distances in meters, and bearings between arrays of coordinates
+    """
+    lat_from = lat1 * DEG_TO_RAD
+    lat_to = lat2 * DEG_TO_RAD
+    lon_from = lng1 * DEG_TO_RAD
+    lon_to = lng2 * DEG_TO_RAD
+
+    lat_delta = lat_to - lat_from
+    lon_delta = lon_to - lon_from
+
+    partial_angle = np.sin(lat_delta/2) * np.sin(lat_delta/2) + np.sin(lon_delta/2) * np.sin(lon_delta/2) * np.cos(lat_from) * np.cos(lat_to)
+    angle = 2 * atan2(np.sqrt(partial_angle), np.sqrt(1-partial_angle))
+
+    distance = angle * EARTH_RADIUS
+
+    x = np.cos(lat_from)*np.sin(lon_delta)
+    y = np.cos(lat_from)*np.sin(lat_to) - np.sin(lat_from)*np.cos(lat_to)*np.cos(lon_delta)
+
+    bearing = atan2(y, x)
+
+    return np.stack([distance * np.cos(bearing), distance * np.sin(bearing)], axis=-1), distance, np.degrees(bearing) + 90.0
+
+
+def time_deltas_ms(transmissions):
+    prev = transmissions[:-1]
+    curr = transmissions[1:]
+
+    # dataframe times are more precise, so prefer them when both transmissions have one
+    has_time = ~np.isnan(curr['time']) & ~np.isnan(prev['time'])
+    # convert to ms so that it's interoperable with transmit_time
+    return np.where(has_time, (curr['time'] - prev['time']) * 1000, curr['transmit_time'] - prev['transmit_time'])
+
+
+def comparable_mask(transmissions, deltas_ms=None):
+    """
+    Whether each transmission after the first can be compared against the model
+    """
+    if len(transmissions) < 2:
+        return np.zeros(0, dtype=bool)
+
+    if deltas_ms is None:
+        deltas_ms = time_deltas_ms(transmissions)
+
+    lats = transmissions['latitude']
+    lngs = transmissions['longitude']
+    unmoved = (lats[1:] == lats[:-1]) & (lngs[1:] == lngs[:-1])
+
+    # over long comm gaps it's no longer useful
+    mask = ~(deltas_ms > MAX_COMM_GAP)
+
+    # when gps is off it's not useful
+    mask &= ~unmoved
+
+    # also filter it out if the gps just turned back on
+    mask[1:] &= ~unmoved[:-1]
+
+    return mask
+
+
+def get_comparable_indices(transmissions):
+    return np.flatnonzero(comparable_mask(transmissions)) + 1
+
+
+def track_kinematics(transmissions):
+    """
+    Computes the measured movement between each pair of consecutive transmissions, with NaN for the pairs that are
+    not comparable
+    """
+    kinematics = np.empty(max(len(transmissions) - 1, 0), dtype=KINEMATICS_DTYPE)
+    for name in KINEMATICS_DTYPE.names[1:]:
+        kinematics[name] = np.nan
+
+    if len(kinematics) == 0:
+        kinematics['comparable'] = False
+        return kinematics
+
+    deltas_ms = time_deltas_ms(transmissions)
+    mask = comparable_mask(transmissions, deltas_ms)
+    kinematics['comparable'] = mask
+    kinematics['delta_ms'] = deltas_ms
+
+    prev = transmissions[:-1][mask]
+    curr = transmissions[1:][mask]
+    delta_s = deltas_ms[mask]/1000.0
+
+    distance, displacement, data_bearing = distance_between(prev['latitude'], prev['longitude'], curr['latitude'], curr['longitude'])
+    data_velocity = distance / delta_s[:, None]
+
+    kinematics['data_velocity'][mask] = data_velocity
+    kinematics['data_speed'][mask] = norm(data_velocity)
+    kinematics['speed_upper'][mask] = displacement / (delta_s - 59.99)
+    kinematics['speed_lower'][mask] = displacement / (delta_s + 59.99)
+    kinematics['data_bearing'][mask] = data_bearing
+
+    return kinematics
+
+
+def model_kinematics(model_velocities):
+    """
+    Speeds and bearings of an (n, 2) array of model u, v velocities
+    """
+    # u, v => velocity to the east, velocity to the south
+    # bearing of 0 means due north
+    return norm(model_velocities), np.degrees(atan2(model_velocities[:, 0], -model_velocities[:, 1]))
@@ -1,188 +1,447 @@
-import math
 import numpy as np
-import json
-import os
 import time
 import sys
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from download_habmc_data import download_data_for_mission
-from download_dataframes import download_dataframe_for_mission
-from grib_utils import get_wind_velocity, close_open_grib_files
+from download_dataframes import download_dataframe_for_mission, set_downsample
+from grib_utils import get_wind_velocities, plan_lookups, close_open_grib_files, set_cache_budget, get_cache_stats, CACHE_BUDGET
+from scheduler import find_task_datasets, group_by_datasets, count_decodes
+from dataset_manager import build_index
+from download_grib import download_datasets
 from plot import plot_analysis
-from numpy_encoder import NumpyEncoder
 from analyze_result import analyze_result
 from mission_config import ANALYZED_MISSIONS
+from columns import empty_columns, RESULT_DTYPE
+from result_io import save_result, open_result_stream, checkpoint_path, read_checkpoint, write_checkpoint, remove_checkpoint, FORMATS
+from kinematics import track_kinematics, model_kinematics, get_comparable_indices
 
-MAX_COMM_GAP = 10*60*1000  # max time between transmissions
 MAX_SPEED = 100  # max speed, in m/s before it throws out the data
 
-def distance_between(lat1, lng1, lat2, lng2):
-    """
-    Distance in meters between two sets of coordinates
-    """
-    earth_radius = 6371000
-    deg_to_rad = math.pi / 180
 
-    lat_from = lat1 * deg_to_rad
-    lat_to = lat2 * deg_to_rad
-    lon_from = lng1 * deg_to_rad
-    lon_to = lng2 * deg_to_rad
+def compare_against_habmc(mission, stream=None, resume=False):
+    transmissions = download_data_for_mission(mission)
+    print('\t[Analysis] Beginning analysis of HABMC data for SSI-%s' % mission)
+    return compare_transmissions(transmissions, stream=stream, checkpoint=checkpoint_path(mission, True), resume=resume)
 
-    lat_delta = lat_to - lat_from
-    lon_delta = lon_to - lon_from
 
-    partial_angle = math.sin(lat_delta/2) * math.sin(lat_delta/2) + math.sin(lon_delta/2) * math.sin(lon_delta/2) * math.cos(lat_from) * math.cos(lat_to)
-    angle = 2 * math.atan2(math.sqrt(partial_angle), math.sqrt(1-partial_angle))
-    
-    distance = angle * earth_radius
+def compare_against_dataframe(mission, stream=None, resume=False):
+    transmissions = download_dataframe_for_mission(mission)
+    print('\t[Analysis] Beginning analysis of dataframe data for SSI-%s' % mission)
+    return compare_transmissions(transmissions, stream=stream, checkpoint=checkpoint_path(mission, False), resume=resume)
 
-    x = math.cos(lat_from)*math.sin(lon_delta)
-    y = math.cos(lat_from)*math.sin(lat_to) - math.sin(lat_from)*math.cos(lat_to)*math.cos(lon_delta)
 
-    bearing = math.atan2(y, x)
+# timestamps, latitudes, longitudes, and altitudes to look the wind up at for the given transmissions
+def get_query_points(transmissions, indices):
+    points = transmissions[indices]
+    return points['transmit_time'], points['latitude'], points['longitude'], points['altitude_barometer']
 
-    return np.array([ distance * math.cos(bearing), distance * math.sin(bearing) ]), distance, math.degrees(bearing) + 90.0
 
+# number of transmissions whose model velocities are looked up in one batch
+BATCH_SIZE = 1000
+CHECKPOINT_INTERVAL = 60  # seconds between checkpoints of a running analysis
 
-def compare_against_habmc(mission):
-    transmissions = download_data_for_mission(mission)
-    print('\t[Analysis] Beginning analysis of HABMC data for SSI-%s' % mission)
-    return compare_transmissions(transmissions)
+def compare_transmissions(transmissions, model_velocities=None, stream=None, checkpoint=None, resume=False):
+    """
+    Compares measured against modelled velocities. model_velocities can hold precomputed model velocities aligned
+    with transmissions, in which case the wind is not looked up again. If a stream is given, results are written to
+    it as they are computed. If a checkpoint path is given, the partial result is saved there every
+    CHECKPOINT_INTERVAL seconds, and with resume the analysis continues from it
+    """
+    analysis_start_time = time.time()
+    last_ellapsed = 0
+    last_checkpoint = analysis_start_time
 
+    # one row per transmission after the first
+    result = empty_columns(max(len(transmissions) - 1, 0), RESULT_DTYPE)
 
-def compare_against_dataframe(mission):
-    transmissions = download_dataframe_for_mission(mission)
-    print('\t[Analysis] Beginning analysis of dataframe data for SSI-%s' % mission)
-    return compare_transmissions(transmissions)
+    kinematics = track_kinematics(transmissions)
 
+    first_start = 1
+    saved = read_checkpoint(checkpoint, transmissions) if checkpoint is not None and resume else None
+    if saved is not None:
+        first_start, result, previous_ellapsed = saved
+        # count the time spent before the interruption too
+        analysis_start_time -= previous_ellapsed
+        print('\t[Analysis] Resuming from transmission %d/%d' % (first_start, len(transmissions)))
 
-def compare_transmissions(transmissions):
-    result = []
-    analysis_start_time = time.time()
-    last_ellapsed = 0
+        if stream is not None:
+            stream.write(result[:first_start - 1])
+
+    if model_velocities is None:
+        plan_lookups(*get_query_points(transmissions, np.flatnonzero(kinematics['comparable'][first_start - 1:]) + first_start))
 
-    def generate_empty(transmission):
-        return {
-            'latitude': transmission['latitude'],
-            'longitude': transmission['longitude'],
-            'altitude': transmission['altitude_barometer'],
-            'timestamp': transmission['transmit_time'],
-            'data_speed': None,
-            'speed_upper': None,
-            'speed_lower': None,
-            'model_speed': None,
-            'data_bearing': None,
-            'model_bearing': None,
-            'data_velocity': None,
-            'model_velocity': None,
-            'speed_error': None
-        }
-
-    for i in range(1, len(transmissions)):
-        prev = transmissions[i - 1]
-        curr = transmissions[i]
-
-        # over long comm gaps it's no longer useful
-        if 'time' in curr and 'time' in prev:
-            delta_ms = (curr['time'] - prev['time']) * 1000  # convert to ms so that it's interoperable with transmit_time
+    for batch_start in range(first_start, len(transmissions), BATCH_SIZE):
+        batch_end = min(batch_start + BATCH_SIZE, len(transmissions))
+        comparable = np.flatnonzero(kinematics['comparable'][batch_start - 1:batch_end - 1]) + batch_start
+
+        if model_velocities is None:
+            velocities = get_wind_velocities(*get_query_points(transmissions, comparable))
         else:
-            delta_ms = (curr['transmit_time'] - prev['transmit_time'])
-
-        if delta_ms > MAX_COMM_GAP:
-            result.append(generate_empty(curr))
-            continue
-
-        # when gps is off it's not useful
-        if curr['latitude'] == prev['latitude'] and curr['longitude'] == prev['longitude']:
-            result.append(generate_empty(curr))
-            continue
-
-        # also filter it out if the gps just turned back on
-        if i >= 2:
-            two_ago = transmissions[i - 2]
-            if two_ago['latitude'] == prev['latitude'] and two_ago['longitude'] == prev['longitude']:
-                result.append(generate_empty(curr))
-                continue
-
-        model_velocity = get_wind_velocity(curr['transmit_time'], curr['latitude'], curr['longitude'], curr['altitude_barometer'])
-        model_speed = float(np.linalg.norm(model_velocity))
-        # u, v => velocity to the east, velocity to the south
-        # bearing of 0 means due north
-        model_bearing = math.degrees(math.atan2(model_velocity[0], -model_velocity[1]))
-
-        distance, displacement, data_bearing = distance_between(prev['latitude'], prev['longitude'], curr['latitude'], curr['longitude'])
-        data_velocity = distance / (delta_ms/1000.0)
-        data_speed = float(np.linalg.norm(data_velocity))
-        speed_upper = displacement / (delta_ms/1000.0 - 59.99)
-        speed_lower = displacement / (delta_ms/1000.0 + 59.99)
-
-        # simple filter to throw out trash
-        # if data_speed > MAX_SPEED:
-        #     result.append(generate_empty(curr))
-        #     continue
-
-        result.append({
-            'latitude': curr['latitude'],
-            'longitude': curr['longitude'],
-            'altitude': curr['altitude_barometer'],
-            'timestamp': curr['transmit_time'],
-            'data_speed': data_speed,
-            'speed_upper': speed_upper,
-            'speed_lower': speed_lower,
-            'model_speed': model_speed,
-            'data_bearing': data_bearing,
-            'model_bearing': model_bearing,
-            'data_velocity': data_velocity,
-            'model_velocity': model_velocity,
-            'speed_error': abs(data_speed - model_speed)
-        })
+            velocities = model_velocities[comparable]
+
+        result[batch_start - 1:batch_end - 1] = result_rows(transmissions, kinematics, batch_start, batch_end, comparable, velocities)
 
+        if stream is not None:
+            stream.write(result[batch_start - 1:batch_end - 1])
+
+        if checkpoint is not None and time.time() - last_checkpoint > CHECKPOINT_INTERVAL:
+            write_checkpoint(checkpoint, batch_end, result, transmissions, time.time() - analysis_start_time)
+            last_checkpoint = time.time()
+
+        i = batch_end - 1
         ellapsed = time.time() - analysis_start_time
         if ellapsed - last_ellapsed > 1:
             print('\t[Analysis] %.1f%% (%d/%d) complete, %.2f per second avg (%.2fs ellapsed)' %
                   (100.0*(i / float(len(transmissions))), i, len(transmissions), i / ellapsed, ellapsed))
             last_ellapsed = ellapsed
 
+    if checkpoint is not None:
+        remove_checkpoint(checkpoint)
+
     ellapsed = time.time() - analysis_start_time
     print('\t[Analysis] Analysis complete, took %.2f seconds)' % ellapsed)
 
     return result, ellapsed
 
 
-def run_full_analysis(mission, habmc=True, plot=True):
+def result_rows(transmissions, kinematics, start, end, comparable, velocities):
+    """
+    Result rows of the transmissions from start to end, empty unless they can be compared. comparable holds the indices
+    of the ones that can, and velocities their model velocities
+    """
+    rows = empty_columns(end - start, RESULT_DTYPE)
+    rows['latitude'] = transmissions['latitude'][start:end]
+    rows['longitude'] = transmissions['longitude'][start:end]
+    rows['altitude'] = transmissions['altitude_barometer'][start:end]
+    rows['timestamp'] = transmissions['transmit_time'][start:end]
+
+    model_speed, model_bearing = model_kinematics(velocities)
+
+    # simple filter to throw out trash
+    # comparable = comparable[kinematics['data_speed'][comparable - 1] <= MAX_SPEED]
+
+    compared = comparable - start
+    for name in ['data_speed', 'speed_upper', 'speed_lower', 'data_bearing', 'data_velocity']:
+        rows[name][compared] = kinematics[name][comparable - 1]
+    rows['model_speed'][compared] = model_speed
+    rows['model_bearing'][compared] = model_bearing
+    rows['model_velocity'][compared] = velocities
+    rows['speed_error'][compared] = np.abs(rows['data_speed'][compared] - model_speed)
+
+    return rows
+
+
+def run_full_analysis(mission, habmc=True, plot=True, result_format='json', resume=False):
+    stream = open_result_stream(mission, habmc) if result_format == 'jsonl' else None
+
     if habmc:
-        result, ellapsed = compare_against_habmc(mission)
+        result, ellapsed = compare_against_habmc(mission, stream, resume)
     else:
-        result, ellapsed = compare_against_dataframe(mission)
+        result, ellapsed = compare_against_dataframe(mission, stream, resume)
+
+    save_analysis(mission, habmc, result, ellapsed, plot, result_format, stream)
+
+    close_open_grib_files()
 
-    output_dir = 'data/analyzed'
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
 
+def save_analysis(mission, habmc, result, ellapsed, plot=False, result_format='json', stream=None):
     analyze_result(result, mission, ellapsed)
 
-    with open(output_dir + '/ssi-' + str(mission) + '-%s.json' % ('habmc' if habmc else 'dataframe'), 'w') as f:
-        f.write(json.dumps(result, cls=NumpyEncoder))
+    if stream is not None:
+        # the results have already been written as they were computed
+        stream.close()
+    else:
+        save_result(mission, habmc, result, result_format)
 
     if plot:
         plot_analysis(result)
 
-    close_open_grib_files()
 
-def main():
-    if sys.argv[1] == 'all' and len(sys.argv) >= 2:
-        for mission, has_dataframe in ANALYZED_MISSIONS.items():
-            run_full_analysis(mission, habmc=True, plot=False)
-            if has_dataframe:
-                run_full_analysis(mission, habmc=False, plot=False)
+def get_task_transmissions(mission, habmc):
+    if habmc:
+        return download_data_for_mission(mission)
+
+    return download_dataframe_for_mission(mission)
+
+
+def format_task(task):
+    mission, habmc = task
+    return 'SSI-%d %s' % (mission, 'habmc' if habmc else 'dataframe')
+
+
+def plan_task_groups(tasks):
+    """
+    Groups together the tasks that need the same datasets, so that they can share them when run together
+    """
+    task_datasets = {}
+    for mission, habmc in tasks:
+        transmissions = get_task_transmissions(mission, habmc)
+        timestamps = get_query_points(transmissions, get_comparable_indices(transmissions))[0]
+        task_datasets[(mission, habmc)] = find_task_datasets(timestamps)
+
+    groups = group_by_datasets(task_datasets)
+    decodes = count_decodes(task_datasets, groups)
+
+    print('\t[Analysis] Scheduled %d analyses in %d groups: %d dataset decodes instead of %d (%d saved)' % (
+        len(tasks), len(groups), decodes['scheduled_decodes'], decodes['naive_decodes'], decodes['saved_decodes']
+    ))
+    for group in groups:
+        print('\t[Analysis]\t %s' % ', '.join(format_task(task) for task in group))
+
+    return groups, decodes
+
+
+def compute_model_velocities(task_transmissions, streams=None):
+    """
+    Looks up the model velocities for several tasks in a single sweep forwards in time, so that each dataset is
+    decoded once no matter how many of the tasks need it. Returns velocities aligned with each task's transmissions.
+    streams can hold a result stream for each task, which its result rows are written to as soon as the velocities they
+    need have been looked up, rather than once the whole sweep is done
+    """
+    streams = {} if streams is None else streams
+    tasks = list(task_transmissions.keys())
+    indices = [get_comparable_indices(task_transmissions[task]) for task in tasks]
+    points = [get_query_points(task_transmissions[task], task_indices) for task, task_indices in zip(tasks, indices)]
+    offsets = np.cumsum([0] + [len(task_indices) for task_indices in indices])
+
+    timestamps, lats, lons, altitudes = [np.concatenate([task_points[axis] for task_points in points]) for axis in range(4)]
+    order = np.argsort(timestamps, kind='stable')
+    plan_lookups(timestamps, lats, lons, altitudes)
+
+    # for each streamed task, its kinematics, how many of its lookups are written, and the next transmission to write
+    written = {task: [track_kinematics(task_transmissions[task]), 0, 1] for task in tasks if task in streams}
+    looked_up = np.zeros(len(timestamps), dtype=bool)
+
+    start_time = time.time()
+    last_ellapsed = 0
+    velocities = np.empty((len(timestamps), 2))
+    for batch_start in range(0, len(order), BATCH_SIZE):
+        batch = order[batch_start:batch_start + BATCH_SIZE]
+        velocities[batch] = get_wind_velocities(timestamps[batch], lats[batch], lons[batch], altitudes[batch])
+        looked_up[batch] = True
+
+        for task, task_indices, offset in zip(tasks, indices, offsets):
+            if task in written:
+                stream_looked_up(task_transmissions[task], streams[task], written[task], task_indices, looked_up[offset:], velocities[offset:])
+
+        done = batch_start + len(batch)
+        ellapsed = time.time() - start_time
+        if ellapsed - last_ellapsed > 1:
+            print('\t[Analysis] Model velocities %.1f%% (%d/%d) complete, %.2f per second avg (%.2fs ellapsed)' %
+                  (100.0*done / len(order), done, len(order), done / ellapsed, ellapsed))
+            last_ellapsed = ellapsed
+
+    # tasks without any lookups have not been written yet
+    for task, task_indices, offset in zip(tasks, indices, offsets):
+        if task in written:
+            stream_looked_up(task_transmissions[task], streams[task], written[task], task_indices, looked_up[offset:], velocities[offset:])
+
+    model_velocities = {}
+    for task, task_indices, offset in zip(tasks, indices, offsets):
+        task_velocities = np.full((len(task_transmissions[task]), 2), np.nan)
+        task_velocities[task_indices] = velocities[offset:offset + len(task_indices)]
+        model_velocities[task] = task_velocities
+
+    return model_velocities
+
+
+def stream_looked_up(transmissions, stream, written, indices, looked_up, velocities):
+    """
+    Writes the result rows of a task up to its first comparable transmission whose velocity has not been looked up
+    yet. written holds the task's kinematics, how many of its lookups have been written, and the next transmission to
+    write, and is updated. looked_up and velocities are aligned with the task's comparable indices
+    """
+    kinematics, first_lookup, start = written
+
+    lookups = first_lookup
+    while lookups < len(indices) and looked_up[lookups]:
+        lookups += 1
+
+    end = indices[lookups] if lookups < len(indices) else len(transmissions)
+    if end <= start:
         return
 
-    mission = int(sys.argv[1]) if len(sys.argv) >= 2 else 63
-    habmc = True
+    stream.write(result_rows(transmissions, kinematics, start, end, indices[first_lookup:lookups], velocities[first_lookup:lookups]))
+    written[1:] = [lookups, end]
+
+
+def run_task_group(tasks, result_format='json'):
+    """
+    Runs analyses that share a decoded dataset cache. Returns how many datasets had to be loaded
+    """
+    loads_before = get_cache_stats()['loads']
+
+    task_transmissions = {task: get_task_transmissions(*task) for task in tasks}
+
+    # fetch every dataset the group needs up front, several at a time
+    download_datasets(find_task_datasets(np.concatenate([
+        get_query_points(transmissions, get_comparable_indices(transmissions))[0] for transmissions in task_transmissions.values()
+    ])))
+
+    # results are streamed during the sweep, which is where the time goes
+    streams = {task: open_result_stream(*task) for task in tasks} if result_format == 'jsonl' else {}
+    model_velocities = compute_model_velocities(task_transmissions, streams)
+
+    for task in tasks:
+        mission, habmc = task
+        print('\t[Analysis] Beginning analysis of %s' % format_task(task))
+        result, ellapsed = compare_transmissions(task_transmissions[task], model_velocities[task])
+        save_analysis(mission, habmc, result, ellapsed, result_format=result_format, stream=streams.get(task))
+
+    loads = get_cache_stats()['loads'] - loads_before
+    close_open_grib_files()
+
+    return loads
+
+
+def sync_habmc_data(missions):
+    # brings the cached HABMC transmissions up to date before they are analyzed
+    for mission in missions:
+        download_data_for_mission(mission, sync=True)
+
+
+def get_analysis_tasks():
+    tasks = []
+    for mission, has_dataframe in ANALYZED_MISSIONS.items():
+        tasks.append((mission, True))
+        if has_dataframe:
+            tasks.append((mission, False))
+
+    return tasks
+
+
+class PrefixedOutput:
+    """
+    Prefixes every line written to it, writing whole lines at once so that the output of several processes sharing
+    a terminal does not get interleaved mid-line
+    """
+
+    def __init__(self, stream, prefix):
+        self.stream = stream
+        self.prefix = prefix
+        self.buffer = ''
 
-    if len(sys.argv) >= 3 and sys.argv[2] == 'dataframe':
-        habmc = False
+    def write(self, text):
+        self.buffer += text
+
+        if '\n' not in self.buffer:
+            return len(text)
+
+        lines, self.buffer = self.buffer.rsplit('\n', 1)
+        self.stream.write(''.join(self.prefix + line + '\n' for line in lines.split('\n')))
+        self.stream.flush()
+
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def init_worker(cache_budget, downsample=None):
+    # each worker starts with empty caches, so only the memory budget needs to be split between them
+    set_cache_budget(cache_budget)
+
+    if downsample is not None:
+        set_downsample(downsample)
+
+
+def run_task_group_with_prefix(tasks, result_format='json'):
+    stdout = sys.stdout
+    sys.stdout = PrefixedOutput(stdout, '[%s] ' % ', '.join(format_task(task) for task in tasks))
+
+    try:
+        return run_task_group(tasks, result_format)
+    finally:
+        sys.stdout.flush()
+        sys.stdout = stdout
+
+
+def run_all(jobs=1, schedule='affinity', result_format='json', downsample=None):
+    tasks = get_analysis_tasks()
+
+    # build the index up front so the workers only ever read it
+    build_index()
+
+    if schedule == 'affinity':
+        groups, decodes = plan_task_groups(tasks)
+    else:
+        groups = [[task] for task in tasks]
+        decodes = None
+
+    loads = 0
+    if jobs <= 1:
+        for group in groups:
+            loads += run_task_group(group, result_format)
+    else:
+        loads = run_task_groups_in_parallel(groups, jobs, result_format, downsample)
+
+    if decodes is not None:
+        print('\t[Analysis] Loaded %d datasets (planned %d, %d with one analysis at a time)' % (
+            loads, decodes['scheduled_decodes'], decodes['naive_decodes']
+        ))
+    else:
+        print('\t[Analysis] Loaded %d datasets' % loads)
+
+
+def run_task_groups_in_parallel(groups, jobs, result_format='json', downsample=None):
+    print('\t[Analysis] Running %d groups of analyses with %d processes' % (len(groups), jobs))
+
+    # spawn rather than fork so that every worker starts with fresh grib and index caches
+    context = multiprocessing.get_context('spawn')
+    loads = 0
+    failures = []
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context, initializer=init_worker, initargs=(CACHE_BUDGET // jobs, downsample)) as executor:
+        futures = {executor.submit(run_task_group_with_prefix, group, result_format): group for group in groups}
+
+        for future in as_completed(futures):
+            group = futures[future]
+            description = ', '.join(format_task(task) for task in group)
+            try:
+                loads += future.result()
+                print('\t[Analysis] Finished %s' % description)
+            except Exception as e:
+                print('\t[Analysis] %s failed: %s' % (description, e))
+                failures.append(group)
+
+    if len(failures) > 0:
+        raise Exception('%d of %d groups of analyses failed' % (len(failures), len(groups)))
+
+    return loads
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mission', nargs='?', default='63', help='mission number, or "all"')
+    parser.add_argument('source', nargs='?', default='habmc', choices=['habmc', 'dataframe'])
+    parser.add_argument('--jobs', type=int, default=1, help='number of analyses to run in parallel with "all"')
+    parser.add_argument('--schedule', default='affinity', choices=['affinity', 'naive'],
+                        help='with "all", whether to group analyses that share datasets or run each on its own')
+    parser.add_argument('--format', default='json', choices=FORMATS, dest='result_format',
+                        help='format to write results to data/analyzed in')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue a single analysis from its last checkpoint instead of starting over')
+    parser.add_argument('--sync', action='store_true',
+                        help='download the HABMC transmissions sent since they were cached before analyzing them')
+    parser.add_argument('--downsample', type=int, default=None,
+                        help='keep one dataframe row out of this many (180 by default, or DATAFRAME_DOWNSAMPLE)')
+    args = parser.parse_args()
+
+    if args.downsample is not None:
+        if args.downsample < 1:
+            parser.error('--downsample must be at least 1')
+
+        set_downsample(args.downsample)
+
+    if args.sync:
+        sync_habmc_data(list(ANALYZED_MISSIONS) if args.mission == 'all' else [int(args.mission)])
+
+    if args.mission == 'all':
+        run_all(args.jobs, args.schedule, args.result_format, args.downsample)
+        return
 
-    run_full_analysis(mission, habmc)
+    run_full_analysis(int(args.mission), args.source == 'habmc', result_format=args.result_format, resume=args.resume)
 
 if __name__ == "__main__":
     main()
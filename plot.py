@@ -1,9 +1,22 @@
 import numpy as np
-import json
 import os
 import plotly.offline as py
 import plotly.graph_objs as go
 import sys
+from result_io import load_result
+
+MAX_FILTER_GAP = 60*60*1000  # ms, points further apart than this are not averaged together
+
+# long flights are decimated to at most this many points per line and markers per map, 0 plots every point
+MAX_PLOT_POINTS = int(os.environ.get('PLOT_MAX_POINTS', 5000))
+# lines are drawn with WebGL, which stays responsive with many more points than SVG
+WEBGL = os.environ.get('PLOT_WEBGL', '1') == '1'
+
+MAX_HISTOGRAM_BINS = 200  # the speed error histogram has as many bins as numpy picks, up to this many
+MAX_BINNING_STEPS = 64  # times the map cells can double in size
+REFINE_BINNING_STEPS = 8  # halvings of the range the map cell size is narrowed down in after that
+
+MARKER_KEYS = ['latitude', 'longitude', 'speed_error', 'data_speed', 'model_speed']
 
 def plot_map(data):
     layout = go.Layout(
@@ -25,123 +38,229 @@ def plot_map(data):
 
     py.plot(fig, filename='plots/speed_error.html')
 
+def get_hover_text(info):
+    return ['Error: %.2fm/s (%.2f m/s measured vs %.2f m/s predicted)' % values for values in zip(info['speed_error'].tolist(), info['data_speed'].tolist(), info['model_speed'].tolist())]
+
+# markers with a position and a value for key, which their size and color are made from
+def drawable_markers(info, key):
+    drawable = np.isfinite(info['latitude']) & np.isfinite(info['longitude']) & np.isfinite(info[key])
+    return {name: np.asarray(info[name], dtype=float)[drawable] for name in MARKER_KEYS}
+
 def plot_speed_error_map(info):
-    max_error = np.array(list(map(lambda point: point['speed_error'], info))).max()
+    markers = drawable_markers(bin_markers(info), 'speed_error')
+    max_error = np.max(markers['speed_error'], initial=0.0) or 1.0
 
     data = [
         go.Scattermapbox(
-            lat=list(map(lambda point: point['latitude'], info)),
-            lon=list(map(lambda point: point['longitude'], info)),
+            lat=markers['latitude'],
+            lon=markers['longitude'],
             mode='markers',
             marker=dict(
-                size=list(map(lambda point: point['speed_error']/6.0 + 3.0, info)),
-                color=list(map(lambda point: 1.0 - (1.0 - point['speed_error']/max_error)**2, info)),
+                size=markers['speed_error']/6.0 + 3.0,
+                color=1.0 - (1.0 - markers['speed_error']/max_error)**2,
                 colorscale='Reds'
             ),
-            text=list(map(lambda point: 'Error: %.2fm/s (%.2f m/s measured vs %.2f m/s predicted)' % (point['speed_error'], point['data_speed'], point['model_speed']), info)),
+            text=get_hover_text(markers),
         ),
     ]
 
     plot_map(data)
 
 def plot_speed_map(info):
-    max_data_speed = np.array(list(map(lambda point: point['data_speed'], info))).max()
-    max_model_speed = np.array(list(map(lambda point: point['model_speed'], info))).max()
+    info = bin_markers(info)
+    data_markers = drawable_markers(info, 'data_speed')
+    model_markers = drawable_markers(info, 'model_speed')
+    max_data_speed = np.max(data_markers['data_speed'], initial=0.0) or 1.0
+    max_model_speed = np.max(model_markers['model_speed'], initial=0.0) or 1.0
 
     data = [
         go.Scattermapbox(
-            lat=list(map(lambda point: point['latitude'], info)),
-            lon=list(map(lambda point: point['longitude'], info)),
+            lat=data_markers['latitude'],
+            lon=data_markers['longitude'],
             mode='markers',
             marker=dict(
-                size=list(map(lambda point: point['data_speed']/6.0 + 3.0, info)),
-                color=list(map(lambda point: point['data_speed']/max_data_speed, info)),
+                size=data_markers['data_speed']/6.0 + 3.0,
+                color=data_markers['data_speed']/max_data_speed,
                 colorscale='Reds'
             ),
-            text=list(map(lambda point: 'Error: %.2fm/s (%.2f m/s measured vs %.2f m/s predicted)' % (point['speed_error'], point['data_speed'], point['model_speed']), info)),
+            text=get_hover_text(data_markers),
         ),
         go.Scattermapbox(
-            lat=list(map(lambda point: point['latitude'], info)),
-            lon=list(map(lambda point: point['longitude'], info)),
+            lat=model_markers['latitude'],
+            lon=model_markers['longitude'],
             mode='markers',
             marker=dict(
-                size=list(map(lambda point: point['model_speed']/6.0 + 3.0, info)),
-                color=list(map(lambda point: point['model_speed']/max_model_speed, info)),
+                size=model_markers['model_speed']/6.0 + 3.0,
+                color=model_markers['model_speed']/max_model_speed,
                 colorscale='Reds'
             ),
-            text=list(map(lambda point: 'Error: %.2fm/s (%.2f m/s measured vs %.2f m/s predicted)' % (point['speed_error'], point['data_speed'], point['model_speed']), info)),
+            text=get_hover_text(model_markers),
         )
     ]
 
     plot_map(data)
 
 def plot_histogram(info):
-    histogram = go.Histogram(x=list(map(lambda point: point['speed_error'], info)))
+    # binned here rather than by plotly, so that only the counts end up in the plot
+    errors = np.asarray(info['speed_error'], dtype=float)
+    errors = errors[np.isfinite(errors)]
+    edges = np.histogram_bin_edges(errors, bins='auto')
+    if len(edges) > MAX_HISTOGRAM_BINS + 1:
+        edges = np.histogram_bin_edges(errors, bins=MAX_HISTOGRAM_BINS)
+    counts, edges = np.histogram(errors, bins=edges)
 
-    py.plot([histogram], filename='plots/speed_error_histogram.html')
+    histogram = go.Bar(x=(edges[:-1] + edges[1:]) / 2.0, y=counts, width=np.diff(edges))
 
+    py.plot(go.Figure(data=[histogram], layout=dict(bargap=0)), filename='plots/speed_error_histogram.html')
 
-def filter_data(info, key, filter_size=0):
-    filtered_data = []
-    for i in range(len(info)):
-        if info[i][key] is None:
-            filtered_data.append(None)
-            continue
-
-        cur_sum = 0.0
-        count = 0
-        filter_range = range(-int(filter_size/2), int(filter_size/2)) if filter_size >= 2 else [0]
-        for j in filter_range:
-            if i - j < 0:
-                break
-
-            if i - j >= len(info):
-                continue
 
-            if info[i-j][key] is None:
-                continue
-
-            delta_time = abs(info[i]['timestamp'] - info[i-j]['timestamp'])
-            if delta_time > 60*60*1000:
-                continue
+def filter_data(info, key, filter_size=0):
+    """
+    Mean of key over the filter_size points around each point (from filter_size/2 - 1 before it to filter_size/2 after
+    it), leaving out NaNs and points more than MAX_FILTER_GAP apart from it. Points that are NaN stay NaN. Timestamps are
+    expected in increasing order, as they are in results
+    """
+    values = np.array(info[key], dtype=float)
+    if filter_size < 2 or len(values) == 0:
+        return values
+
+    half = int(filter_size/2)
+    timestamps = np.asarray(info['timestamp'], dtype=float)
+    valid = ~np.isnan(values)
+
+    # subtracting the mean keeps the differences of the cumulative sums precise over long flights
+    offset = float(np.mean(values[valid])) if np.any(valid) else 0.0
+    sums = np.concatenate([[0.0], np.cumsum(np.where(valid, values - offset, 0.0))])
+    counts = np.concatenate([[0], np.cumsum(valid)])
+
+    indices = np.arange(len(values))
+    starts = np.maximum(indices - half + 1, np.searchsorted(timestamps, timestamps - MAX_FILTER_GAP, side='left'))
+    ends = np.minimum(indices + half + 1, np.searchsorted(timestamps, timestamps + MAX_FILTER_GAP, side='right'))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        filtered_data = (sums[ends] - sums[starts]) / (counts[ends] - counts[starts]) + offset
+    filtered_data[~valid] = np.nan
 
-            cur_sum += info[i-j][key]
-            count += 1
+    return filtered_data
 
-        filtered_data.append(cur_sum/float(count))
 
-    return filtered_data
+def lttb(x, y, threshold):
+    """
+    Indices of threshold of the points that keep the shape of the line through them, using largest triangle three
+    buckets: the first and last points are kept, and from each bucket of points in between, the one that makes the
+    largest triangle with the point kept before it and the average of the next bucket
+    """
+    if threshold >= len(x) or threshold < 3:
+        return np.arange(len(x))
+
+    edges = np.linspace(1, len(x) - 1, threshold - 1).astype(int)
+
+    indices = np.empty(threshold, dtype=int)
+    indices[0] = 0
+    indices[-1] = len(x) - 1
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        if bucket + 2 < len(edges):
+            next_x = np.mean(x[end:edges[bucket + 2]])
+            next_y = np.mean(y[end:edges[bucket + 2]])
+        else:
+            next_x, next_y = x[-1], y[-1]
+
+        previous = indices[bucket]
+        areas = np.abs((x[previous] - next_x)*(y[start:end] - y[previous]) - (x[previous] - x[start:end])*(next_y - y[previous]))
+        indices[bucket + 1] = start + np.argmax(areas)
+
+    return indices
+
+
+def line_trace(x, y, name):
+    """
+    Scatter trace of a line, decimated to MAX_PLOT_POINTS. Decimated lines leave out their NaNs, rather than breaking
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if MAX_PLOT_POINTS > 0 and len(x) > MAX_PLOT_POINTS:
+        finite = np.flatnonzero(~np.isnan(y))
+        kept = finite[lttb(x[finite], y[finite], MAX_PLOT_POINTS)]
+        x, y = x[kept], y[kept]
+
+    return (go.Scattergl if WEBGL else go.Scatter)(x=x, y=y, name=name)
+
+
+def bin_markers(info, max_points=None):
+    """
+    Merges the markers in each cell of a latitude/longitude grid into one, averaging their values, with the cells as
+    small as they can be while leaving at most max_points (MAX_PLOT_POINTS by default) markers
+    """
+    max_points = MAX_PLOT_POINTS if max_points is None else max_points
+    if max_points <= 0 or len(info['latitude']) <= max_points:
+        return info
+
+    # markers without a position cannot be drawn, so they are left out
+    lats = np.asarray(info['latitude'], dtype=float)
+    lngs = np.asarray(info['longitude'], dtype=float)
+    positioned = np.isfinite(lats) & np.isfinite(lngs)
+    lats = lats[positioned]
+    lngs = lngs[positioned]
+    if len(lats) == 0:
+        return {key: np.asarray(info[key], dtype=float)[positioned] for key in MARKER_KEYS}
+
+    lats = lats - lats.min()
+    lngs = lngs - lngs.min()
+
+    def bin_cells(cell_size):
+        # cells are numbered row by row, which is much faster to find the unique ones of than pairs
+        lng_cells = np.floor(lngs / cell_size).astype(np.int64)
+        cells = np.floor(lats / cell_size).astype(np.int64) * (lng_cells.max() + 1) + lng_cells
+        _, cell_of, counts = np.unique(cells, return_inverse=True, return_counts=True)
+        return cell_of, counts
+
+    # once a cell is larger than the extent of the markers they all fall in the first one, so this always ends
+    too_small = None
+    cell_size = max(lats.max(), lngs.max(), 1e-6) / max_points
+    for _ in range(MAX_BINNING_STEPS):
+        cell_of, counts = bin_cells(cell_size)
+        if len(counts) <= max_points:
+            break
+
+        too_small = cell_size
+        cell_size *= 2
+
+    # doubling the cells can quarter the markers, so narrow the size down between the last two tried
+    if too_small is not None:
+        for _ in range(REFINE_BINNING_STEPS):
+            middle = (too_small + cell_size) / 2
+            middle_cell_of, middle_counts = bin_cells(middle)
+            if len(middle_counts) <= max_points:
+                cell_size, cell_of, counts = middle, middle_cell_of, middle_counts
+            else:
+                too_small = middle
+
+    binned = {}
+    for key in MARKER_KEYS:
+        values = np.asarray(info[key], dtype=float)[positioned]
+        valid = ~np.isnan(values)
+        sums = np.bincount(cell_of, weights=np.where(valid, values, 0.0), minlength=len(counts))
+        valid_counts = np.bincount(cell_of, weights=valid, minlength=len(counts))
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            binned[key] = sums / valid_counts
+
+    return binned
 
 
 def get_timestamps(info):
-    min_timestamp = np.array(list(map(lambda point: point['timestamp'], info))).min()
-    return [(value['timestamp'] - min_timestamp) / 1000.0 / 60.0 / 60.0 for value in info]
+    return (info['timestamp'] - info['timestamp'].min()) / 1000.0 / 60.0 / 60.0
 
 
 def plot_speed_comparison(info):
     timestamps = get_timestamps(info)
 
     fig = go.Figure(data=[
-        go.Scatter(
-            x = timestamps,
-            y = np.array(filter_data(info, 'data_speed')),
-            name = 'data speed (smoothed)'
-        ),
-        go.Scatter(
-            x = timestamps,
-            y = np.array(list(map(lambda point: point['model_speed'], info))),
-            name = 'model speed'
-        ),
-        # go.Scatter(
-        #     x = timestamps,
-        #     y = np.array(filter_data(info, 'speed_upper')),
-        #     name = 'data speed (upper bound, smoothed)'
-        # ),
-        # go.Scatter(
-        #     x = timestamps,
-        #     y = np.array(filter_data(info, 'speed_lower')),
-        #     name = 'data speed (lower bound, smoothed)'
-        # )
+        line_trace(timestamps, filter_data(info, 'data_speed'), 'data speed (smoothed)'),
+        line_trace(timestamps, info['model_speed'], 'model speed'),
+        # line_trace(timestamps, filter_data(info, 'speed_upper'), 'data speed (upper bound, smoothed)'),
+        # line_trace(timestamps, filter_data(info, 'speed_lower'), 'data speed (lower bound, smoothed)'),
     ], layout=dict(
         title='Speed comparison',
         xaxis=dict(
@@ -158,16 +277,8 @@ def plot_bearing_comparison(info):
     timestamps = get_timestamps(info)
 
     fig = go.Figure(data=[
-        go.Scatter(
-            x = timestamps,
-            y = np.array(filter_data(info, 'data_bearing')),
-            name = 'data bearing (smoothed)'
-        ),
-        go.Scatter(
-            x = timestamps,
-            y = np.array(list(map(lambda point: point['model_bearing'], info))),
-            name = 'model bearing'
-        )
+        line_trace(timestamps, filter_data(info, 'data_bearing'), 'data bearing (smoothed)'),
+        line_trace(timestamps, info['model_bearing'], 'model bearing')
     ], layout=dict(
         title='Bearing comparison',
         xaxis=dict(
@@ -184,26 +295,10 @@ def plot_velocity_comparison(info):
     timestamps = get_timestamps(info)
 
     fig = go.Figure(data=[
-        go.Scatter(
-            x = timestamps,
-            y = np.array(filter_data(info, 'data_speed')),
-            name = 'data speed (smoothed)'
-        ),
-        go.Scatter(
-            x = timestamps,
-            y = np.array(list(map(lambda point: point['model_speed'], info))),
-            name = 'model speed'
-        ),
-        go.Scatter(
-            x = timestamps,
-            y = np.array(filter_data(info, 'data_bearing')),
-            name = 'data bearing (smoothed)'
-        ),
-        go.Scatter(
-            x = timestamps,
-            y = np.array(list(map(lambda point: point['model_bearing'], info))),
-            name = 'model bearing'
-        )
+        line_trace(timestamps, filter_data(info, 'data_speed'), 'data speed (smoothed)'),
+        line_trace(timestamps, info['model_speed'], 'model speed'),
+        line_trace(timestamps, filter_data(info, 'data_bearing'), 'data bearing (smoothed)'),
+        line_trace(timestamps, info['model_bearing'], 'model bearing')
     ], layout=dict(
         title='Velocity comparison',
         xaxis=dict(
@@ -237,6 +332,9 @@ if __name__ == "__main__":
     mission = int(sys.argv[2]) if len(sys.argv) >= 3 else 63
     ending = str(sys.argv[3]) if len(sys.argv) >= 4 else 'dataframe'
 
-    with open('data/analyzed/ssi-%s-%s.json' % (mission, ending)) as f:
-        contents = json.loads(f.read())
+    contents = load_result(mission, ending == 'habmc')
+    if contents is None:
+        print('No analysis of SSI-%s %s found' % (mission, ending))
+        sys.exit(1)
+
     plot_analysis(contents, sys.argv[1] if len(sys.argv) >= 2 else None)
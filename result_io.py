@@ -0,0 +1,182 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import numpy as np
+from numpy_encoder import NumpyEncoder
+from columns import empty_columns, to_records, results_from_records, RESULT_DTYPE
+
+"""
+Reading and writing of analysis results in data/analyzed. Results can be written as json (a list of records), as
+jsonl (one record per line, which can be written as the results are computed, see ResultStream), or as npz (one array
+per column), which is much smaller and faster to load. Readers use whichever was written last
+"""
+
+OUTPUT_DIR = 'data/analyzed'
+FORMATS = ['json', 'jsonl', 'npz']
+
+FLUSH_INTERVAL = 10  # seconds between flushes of streamed results to disk
+
+
+class ResultStream:
+    """
+    Writes results to a jsonl file as they are computed, so that they never have to be serialized all at once. Lines
+    go to a .partial file that is flushed to disk every FLUSH_INTERVAL seconds, so that a run that crashes keeps what
+    it had computed, and that is moved into place once the analysis is complete
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.path = path
+        self.partial_path = path + '.partial'
+        self.file = open(self.partial_path, 'w')
+        self.last_flush = time.time()
+
+    def write(self, rows):
+        self.file.write(''.join(json.dumps(record, cls=NumpyEncoder) + '\n' for record in to_records(rows)))
+
+        if time.time() - self.last_flush > FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        os.replace(self.partial_path, self.path)
+
+        return self.path
+
+
+def result_path(mission, habmc, result_format='json'):
+    return '%s/ssi-%s-%s.%s' % (OUTPUT_DIR, str(mission), 'habmc' if habmc else 'dataframe', result_format)
+
+
+# the most recently written result for a mission, or None if it has not been analyzed
+def find_result_file(mission, habmc):
+    paths = [result_path(mission, habmc, result_format) for result_format in FORMATS]
+    paths = [path for path in paths if os.path.isfile(path)]
+    if len(paths) == 0:
+        return None
+
+    return max(paths, key=os.path.getmtime)
+
+
+def write_result(path, result):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # write to a temporary file first so that a partially written file is never read
+    partial_path = '%s.%d.partial' % (path, os.getpid())
+    with open(partial_path, 'wb' if path.endswith('.npz') else 'w') as f:
+        if path.endswith('.npz'):
+            np.savez(f, **{name: result[name] for name in result.dtype.names})
+        elif path.endswith('.jsonl'):
+            f.write(''.join(json.dumps(record, cls=NumpyEncoder) + '\n' for record in to_records(result)))
+        else:
+            f.write(json.dumps(to_records(result), cls=NumpyEncoder))
+    os.replace(partial_path, path)
+
+    return path
+
+
+def read_result(path):
+    if path.endswith('.npz'):
+        with np.load(path) as columns:
+            result = empty_columns(len(columns[RESULT_DTYPE.names[0]]), RESULT_DTYPE)
+            for name in RESULT_DTYPE.names:
+                if name in columns:
+                    result[name] = columns[name]
+
+        return result
+
+    with open(path) as f:
+        if path.endswith('.jsonl'):
+            return results_from_records([json.loads(line) for line in f if line.strip() != ''])
+
+        return results_from_records(json.loads(f.read()))
+
+
+def save_result(mission, habmc, result, result_format='json'):
+    return write_result(result_path(mission, habmc, result_format), result)
+
+
+def open_result_stream(mission, habmc):
+    return ResultStream(result_path(mission, habmc, 'jsonl'))
+
+
+def checkpoint_path(mission, habmc):
+    return '%s/ssi-%s-%s.checkpoint.npz' % (OUTPUT_DIR, str(mission), 'habmc' if habmc else 'dataframe')
+
+
+# identifies the transmissions a checkpoint was made for, so it is not resumed with different ones
+def fingerprint(transmissions):
+    return hashlib.sha256(np.ascontiguousarray(transmissions).tobytes()).hexdigest()
+
+
+def write_checkpoint(path, next_start, result, transmissions, ellapsed):
+    """
+    Saves the partial result of an analysis, which has been computed up to (but not including) the transmission at
+    next_start, along with the seconds spent on it so far
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    partial_path = '%s.%d.partial' % (path, os.getpid())
+    with open(partial_path, 'wb') as f:
+        np.savez(f, next_start=next_start, result=result, fingerprint=fingerprint(transmissions), ellapsed=ellapsed)
+    os.replace(partial_path, path)
+
+
+def read_checkpoint(path, transmissions):
+    """
+    Returns the next_start, partial result, and ellapsed seconds saved for the given transmissions, or None if there
+    is no usable checkpoint
+    """
+    if not os.path.isfile(path):
+        return None
+
+    with np.load(path) as checkpoint:
+        if str(checkpoint['fingerprint']) != fingerprint(transmissions) or checkpoint['result'].dtype != RESULT_DTYPE:
+            print('\t[Results] Ignoring checkpoint %s made for other transmissions' % path)
+            return None
+
+        return int(checkpoint['next_start']), checkpoint['result'], float(checkpoint['ellapsed'])
+
+
+def remove_checkpoint(path):
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def load_result(mission, habmc):
+    path = find_result_file(mission, habmc)
+    if path is None:
+        return None
+
+    return read_result(path)
+
+
+# converts every json or jsonl result in the output directory that has no up to date npz next to it
+def convert_results(directory=OUTPUT_DIR, debug=True):
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(('.json', '.jsonl')) or filename.endswith('-analysis.json'):
+            continue
+
+        source_path = directory + '/' + filename
+        npz_path = source_path.rsplit('.', 1)[0] + '.npz'
+        if os.path.isfile(npz_path) and os.path.getmtime(npz_path) >= os.path.getmtime(source_path):
+            continue
+
+        if debug:
+            print('\t[Results] Converting %s' % filename)
+
+        write_result(npz_path, read_result(source_path))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == 'convert':
+        convert_results()
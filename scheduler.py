@@ -0,0 +1,63 @@
+import numpy as np
+import dataset_manager
+
+"""
+Groups analyses that need the same GFS datasets, so that each dataset only has to be decoded once for all of them
+"""
+
+
+# urls of every dataset needed to look up the wind at the given timestamps
+def find_task_datasets(timestamps):
+    if len(timestamps) == 0:
+        return set()
+
+    lower, upper = dataset_manager.find_dataset_indices(timestamps)
+    used = np.unique(np.concatenate([lower, upper]))
+
+    return set(dataset_manager.timeline_urls[used])
+
+
+def group_by_datasets(task_datasets):
+    """
+    Splits tasks into groups that share no datasets with each other, by taking the connected components of the graph
+    of tasks linked by common datasets. Groups are ordered by their earliest dataset, and tasks keep their order
+    """
+    parents = {task: task for task in task_datasets.keys()}
+
+    def find(task):
+        while parents[task] != task:
+            parents[task] = parents[parents[task]]
+            task = parents[task]
+        return task
+
+    owners = {}
+    for task, datasets in task_datasets.items():
+        for dataset in datasets:
+            if dataset in owners:
+                parents[find(task)] = find(owners[dataset])
+            else:
+                owners[dataset] = task
+
+    groups = {}
+    for task in task_datasets.keys():
+        groups.setdefault(find(task), []).append(task)
+
+    def earliest_dataset(group):
+        datasets = set().union(*[task_datasets[task] for task in group])
+        return min(datasets) if len(datasets) > 0 else ''
+
+    return sorted(groups.values(), key=earliest_dataset)
+
+
+def count_decodes(task_datasets, groups):
+    """
+    Number of dataset decodes when every task starts with a cold cache, compared to when each group shares one
+    """
+    naive = sum(len(datasets) for datasets in task_datasets.values())
+    scheduled = sum(len(set().union(*[task_datasets[task] for task in group])) for group in groups)
+
+    return {
+        'naive_decodes': naive,
+        'scheduled_decodes': scheduled,
+        'saved_decodes': naive - scheduled
+    }